@@ -0,0 +1,302 @@
+"""Asynchronous actor/learner training.
+
+Actor processes keep collecting self-play transitions with their own copy of
+the policy and send them to the learner through a bounded queue. The learner
+adds them to its replay buffer, trains, and every `--publish-every` gradient
+steps publishes its weights through a shared-memory copy of the network that
+actors pick up before their next collect. Batches collected with weights more
+than `--max-staleness` versions old are dropped.
+
+    ```
+    python train.py --actors 4 --envs-per-actor 2
+    ```
+"""
+from __future__ import annotations
+
+from train import generate_random_experiment_name, get_agents, get_env, get_monitor, get_reward_shaping
+from monitor import current_rss_bytes
+from seeding import ACTORS, TEST_ENVS, derive_seed
+
+import argparse
+from copy import copy, deepcopy
+import os
+import queue
+import time
+from typing import TYPE_CHECKING, Tuple
+
+import numpy as np
+
+if TYPE_CHECKING:
+    import torch
+    from tianshou.policy import BasePolicy
+
+
+def _sync_weights(policy, shared_net, shared_version, lock) -> int:
+    """Copies the published weights into `policy` and returns their version."""
+    with lock:
+        policy.model.load_state_dict(shared_net.state_dict())
+        return shared_version.value
+
+
+def _actor_main(actor_id: int, args: argparse.Namespace, shared_net, shared_version, lock, transitions, stop_event) -> None:
+    """Collects transitions with the latest published weights until the learner sets stop_event."""
+    import torch
+    from tianshou.data import Collector, VectorReplayBuffer
+    from tianshou.env import DummyVectorEnv
+
+    # actors only run inference, keep them off the learner's device
+    args = copy(args)
+    args.device = "cpu"
+    torch.set_num_threads(1)
+
+    # global RNGs (exploration, random opponents) and every env get their own stream
+    seed = derive_seed(args.seed, ACTORS, actor_id)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    reward_shaping = get_reward_shaping(args)
+    envs = DummyVectorEnv([lambda: get_env(reward_shaping=reward_shaping, obs_type=args.obs_type) for _ in range(args.envs_per_actor)])
+    envs.seed([derive_seed(args.seed, ACTORS, actor_id, i) for i in range(args.envs_per_actor)])
+
+    policy, _, agents = get_agents(args)
+    learner = policy.policies[agents[args.agent_id - 1]]
+    learner.set_eps(args.eps_train)
+    policy.eval()
+
+    buffer = VectorReplayBuffer(args.step_per_collect * 2, args.envs_per_actor)
+    collector = Collector(policy, envs, buffer, exploration_noise=True)
+    version = -1
+
+    while not stop_event.is_set():
+        if shared_version.value != version:
+            version = _sync_weights(learner, shared_net, shared_version, lock)
+
+        collector.reset_buffer(keep_statistics=True)
+        result = collector.collect(n_step=args.step_per_collect)
+        # one ordered chunk per env so the learner can keep every env's transitions contiguous (n-step returns)
+        chunks = [sub[sub.sample_indices(0)] if len(sub) else None for sub in buffer.buffers]
+        # env stepping happens here, so the learner's monitor also tracks the actors' memory
+        payload = (actor_id, version, chunks, result["n/st"], result["n/ep"], result["rews"], current_rss_bytes())
+        while not stop_event.is_set():
+            try:
+                transitions.put(payload, timeout=1.0)
+                break
+            except queue.Full:
+                continue
+    envs.close()
+
+
+def train_actor_learner(args: argparse.Namespace) -> Tuple[dict, BasePolicy]:
+    """Trains like train.train_agent, but with `args.actors` collecting processes feeding one learner."""
+    import torch
+    import torch.multiprocessing as mp
+    from torch.utils.tensorboard import SummaryWriter
+    from tianshou.data import Collector, VectorReplayBuffer
+    from tianshou.env import DummyVectorEnv
+    from tianshou.utils import TensorboardLogger
+
+    assert args.publish_every >= 1, f"--publish-every must be at least 1, got {args.publish_every}"
+    args.exp_id = generate_random_experiment_name()
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    # ======== learner setup =========
+    policy, optim, agents = get_agents(args)
+    learn_agent = agents[args.agent_id - 1]
+    learner = policy.policies[learn_agent]
+    n_actor_envs = args.actors * args.envs_per_actor
+    # sub-buffer actor_id * envs_per_actor + env_id holds that env's transitions in order
+    buffer = VectorReplayBuffer(args.buffer_size, n_actor_envs)
+
+    test_envs = DummyVectorEnv([lambda: get_env(obs_type=args.obs_type) for _ in range(args.test_num)])
+    test_envs.seed([derive_seed(args.seed, TEST_ENVS, i) for i in range(args.test_num)])
+    test_collector = Collector(policy, test_envs, exploration_noise=True)
+
+    log_path = os.path.join(args.logdir, args.exp_id)
+    writer = SummaryWriter(log_path)
+    writer.add_text("args", str(args))
+    logger = TensorboardLogger(writer)
+    monitor = get_monitor(args, logger)
+
+    # ======== shared state =========
+    ctx = mp.get_context("spawn")
+    shared_net = deepcopy(learner.model).to("cpu")
+    shared_net.share_memory()
+    shared_version = ctx.Value("i", 0)
+    lock = ctx.Lock()
+    transitions = ctx.Queue(maxsize=args.queue_size or 2 * args.actors)
+    stop_event = ctx.Event()
+
+    def publish() -> None:
+        with lock:
+            shared_net.load_state_dict(learner.model.state_dict())
+            shared_version.value += 1
+
+    def save_best_fn() -> None:
+        model_save_path = getattr(args, "model_save_path", os.path.join("models", args.exp_id, "policy.pth"))
+        os.makedirs(os.path.dirname(model_save_path) or ".", exist_ok=True)
+        torch.save(learner.state_dict(), model_save_path)
+
+    def test_round() -> float:
+        policy.eval()
+        learner.set_eps(args.eps_test)
+        test_collector.reset()
+        result = test_collector.collect(n_episode=args.test_num)
+        policy.train()
+        return float(result["rews"][:, args.agent_id - 1].mean())
+
+    actors = [
+        ctx.Process(target=_actor_main, args=(i, args, shared_net, shared_version, lock, transitions, stop_event), daemon=True)
+        for i in range(args.actors)
+    ]
+    for actor in actors:
+        actor.start()
+
+    # ======== training loop =========
+    total_steps = args.epoch * args.step_per_epoch
+    env_step, gradient_step, n_episodes, n_dropped = 0, 0, 0, 0
+    last_publish, next_test = 0, args.step_per_epoch
+    best_reward, best_epoch = -np.inf, 0
+    update_credit = 0.0
+    actor_rss = {}
+    start = time.perf_counter()
+    print(f"Training {args.exp_id} with {args.actors} actors for {total_steps} total steps")
+    if monitor is not None:
+        monitor.start()
+    try:
+        while env_step < total_steps:
+            payloads = [_get_payload(transitions, actors)]
+            while True:
+                try:
+                    payloads.append(transitions.get_nowait())
+                except queue.Empty:
+                    break
+
+            for actor_id, version, chunks, n_steps, n_eps, rews, rss in payloads:
+                actor_rss[f"actor{actor_id}"] = rss
+                if shared_version.value - version > args.max_staleness:
+                    n_dropped += 1
+                    for env_id in range(len(chunks)):
+                        _truncate_last(buffer, actor_id * args.envs_per_actor + env_id)
+                    continue
+                for env_id, chunk in enumerate(chunks):
+                    if chunk is None:
+                        continue
+                    _add_chunk(buffer, actor_id * args.envs_per_actor + env_id, chunk)
+                env_step += n_steps
+                n_episodes += n_eps
+                update_credit += n_steps * args.update_per_step
+                if n_eps:
+                    logger.write("train/env_step", env_step, {"train/reward": float(rews[:, args.agent_id - 1].mean())})
+            if monitor is not None:
+                monitor.sample(env_step, n_episodes, worker_rss=actor_rss)
+
+            if len(buffer) >= args.batch_size:
+                while update_credit >= 1:
+                    losses = policy.update(args.batch_size, buffer)
+                    update_credit -= 1
+                    gradient_step += 1
+                if gradient_step - last_publish >= args.publish_every:
+                    publish()
+                    last_publish = gradient_step
+                    elapsed = time.perf_counter() - start
+                    logger.write("train/gradient_step", gradient_step, {
+                        **{f"train/{k}": v for k, v in losses.items() if np.isscalar(v)},
+                        "actor_learner/env_steps_per_sec": env_step / elapsed,
+                        "actor_learner/gradient_steps_per_sec": gradient_step / elapsed,
+                        "actor_learner/dropped_batches": n_dropped,
+                        "actor_learner/queue_size": _queue_size(transitions),
+                        "actor_learner/weights_version": shared_version.value,
+                    })
+
+            if env_step >= next_test:
+                epoch = next_test // args.step_per_epoch
+                next_test += args.step_per_epoch
+                test_reward = test_round()
+                logger.write("test/env_step", env_step, {"test/reward": test_reward})
+                print(f"Epoch #{epoch}: env_step {env_step}, gradient_step {gradient_step}, test_reward {test_reward:.3f}, dropped {n_dropped}")
+                if test_reward > best_reward:
+                    best_reward, best_epoch = test_reward, epoch
+                    save_best_fn()
+                if test_reward >= args.win_rate:
+                    break
+    finally:
+        if monitor is not None:
+            monitor.stop()
+        stop_event.set()
+        # unblock actors waiting on a full queue before joining them
+        while any(a.is_alive() for a in actors):
+            try:
+                transitions.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for actor in actors:
+            actor.join()
+
+    elapsed = time.perf_counter() - start
+    result = {
+        "duration": f"{elapsed:.2f}s",
+        "env_step": env_step,
+        "gradient_step": gradient_step,
+        "n/ep": n_episodes,
+        "dropped_batches": n_dropped,
+        "best_reward": best_reward,
+        "best_epoch": best_epoch,
+    }
+    return result, learner
+
+
+def _get_payload(transitions, actors, timeout: float = 1.0):
+    """Waits for the next batch of transitions. Actors only exit once the learner
+    stops them, so an actor that is gone before that has failed (its traceback
+    is on stderr) and raises instead of leaving the learner waiting forever.
+    """
+    while True:
+        try:
+            return transitions.get(timeout=timeout)
+        except queue.Empty:
+            for i, actor in enumerate(actors):
+                if not actor.is_alive():
+                    raise RuntimeError(f"actor {i} exited with code {actor.exitcode}")
+
+
+def _add_chunk(buffer, buffer_id: int, chunk) -> None:
+    """Appends one env's ordered transitions to sub-buffer `buffer_id` of a
+    VectorReplayBuffer with a single write, keeping the same bookkeeping
+    (sub-buffer index and size, last_index, _lengths) as adding them one by one.
+    """
+    if buffer._meta.is_empty():
+        # the first add allocates the storage the sub-buffers are views into
+        buffer.add(chunk[:1], buffer_ids=[buffer_id])
+        chunk = chunk[1:]
+    sub = buffer.buffers[buffer_id]
+    n = len(chunk)
+    if n == 0:
+        return
+    # only the newest maxsize transitions survive, at the slots they would have been added to
+    skipped = max(0, n - sub.maxsize)
+    indices = (sub._index + np.arange(skipped, n)) % sub.maxsize
+    sub._meta[indices] = chunk[skipped:]
+    sub._index = (sub._index + n) % sub.maxsize
+    sub._size = min(sub._size + n, sub.maxsize)
+    sub.last_index[0] = indices[-1]
+    buffer.last_index[buffer_id] = buffer._offset[buffer_id] + indices[-1]
+    buffer._lengths[buffer_id] = len(sub)
+
+
+def _truncate_last(buffer, buffer_id: int) -> None:
+    """Marks the last transition of a sub-buffer as truncated, so n-step returns
+    do not run across the transitions dropped after it (obs_next is still valid,
+    so it bootstraps like any other truncated episode).
+    """
+    sub = buffer.buffers[buffer_id]
+    if len(sub):
+        last = sub.last_index[0]
+        sub.truncated[last] = True
+        sub.done[last] = True
+
+
+def _queue_size(q) -> int:
+    try:
+        return q.qsize()
+    except NotImplementedError: # macOS
+        return -1
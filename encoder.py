@@ -0,0 +1,49 @@
+"""Planes observation encoder for convolutional networks."""
+from game import Game, PLAYER_INDEX
+import kernel
+
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+
+@dataclass
+class PlanesConfig:
+    """Which planes the encoder writes, on top of the PE/PI/PO planes of every player."""
+    po_counts: bool = True     # remaining POs of every player, scaled to [0, 1]
+    side_to_move: bool = True  # all ones when the observing player is to move
+    last_move: bool = True     # one-hot of the last placed piece
+
+    def n_planes(self, n_players: int) -> int:
+        return 3 * n_players + (n_players if self.po_counts else 0) + int(self.side_to_move) + int(self.last_move)
+
+    def shape(self, n_players: int, board_size: int) -> tuple[int, int, int]:
+        return (self.n_planes(n_players), board_size, board_size)
+
+
+def encode_planes(
+    game: Game,
+    agent: str,
+    out: np.ndarray,
+    config: Optional[PlanesConfig] = None,
+    to_move: Optional[str] = None,
+    last_move: Optional[tuple[int, int]] = None,
+    po_left: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Writes `agent`'s view of the board into `out`, a float32 array of shape config.shape(...).
+    Planes are ordered from `agent`'s point of view (their own pieces first), channel first.
+    The planes are written in place, so the same buffer can be reused across steps
+    (pass an int16 `po_left` buffer of n_players entries as well to allocate nothing).
+    """
+    config = config if config is not None else PlanesConfig()
+    n_players = game.n_players
+    assert out.shape == config.shape(n_players, game.board.board_size), f"Expected a buffer of shape {config.shape(n_players, game.board.board_size)}, not {out.shape}"
+    po_left = game.po_left(po_left)
+    last_x, last_y = last_move if last_move is not None else (-1, -1)
+    kernel.encode_planes(
+        game.board.pieces, game.board.owners, PLAYER_INDEX[agent], po_left, game.max_pos_per_player,
+        to_move == agent, last_x, last_y, config.po_counts, config.side_to_move, config.last_move,
+        game.board.board_size, out,
+    )
+    return out
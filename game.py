@@ -1,7 +1,13 @@
 from dataclasses import dataclass
 from enum import Enum
+import multiprocessing as mp
 from typing import Optional
 
+import numpy as np
+
+import kernel
+from seeding import make_rng
+
 # TODO: turn into string enum
 class Colors:
   BLACK = "\033[30m"
@@ -23,6 +29,9 @@ PLAYER_COLOR_MAP = {
    "player_3": Colors.MAGENTA  # (255, 0, 255)
 }
 
+# player id -> owner index used by the rules kernel
+PLAYER_INDEX = {f"player_{i}": i for i in range(4)}
+
 
 class t_Piece(Enum):
   EMPTY = 0
@@ -51,6 +60,58 @@ class Piece:
         return self.color + "?" + Colors.RESET
 
 
+@dataclass
+class RolloutStats:
+  """Outcome of Game.rollout. `winners` holds the winning player index of every game (-1 on a tie).
+  Game i can be played again move by move with Game.replay_rollout(..., game_id=i, seed=seed).
+  """
+  player_ids: list[str]
+  winners: np.ndarray
+  lengths: np.ndarray
+  seed: int
+
+  @property
+  def n_games(self) -> int:
+    return len(self.winners)
+
+  @property
+  def wins(self) -> dict[str, int]:
+    return {p: int((self.winners == i).sum()) for i, p in enumerate(self.player_ids)}
+
+  @property
+  def ties(self) -> int:
+    return int((self.winners == kernel.NO_OWNER).sum())
+
+  def win_rate(self, player_id: str) -> float:
+    return self.wins[player_id] / self.n_games
+
+  @property
+  def tie_rate(self) -> float:
+    return self.ties / self.n_games
+
+  @property
+  def mean_length(self) -> float:
+    return float(self.lengths.mean())
+
+
+ROLLOUT_CHUNK_SIZE = 256 # games per seed stream, so results do not depend on the number of workers
+
+
+def _rollout_uniforms(seed: int, chunk: int, n_games: int, board_size: int) -> np.ndarray:
+  """Random numbers for the first n_games games of chunk `chunk`, one row per game."""
+  return make_rng(seed, chunk).random((n_games, 2 * board_size * board_size))
+
+
+def _rollout_chunk(task: tuple) -> tuple[np.ndarray, np.ndarray]:
+  """Plays one chunk of Game.rollout, runs in the worker processes."""
+  pieces, owners, po_left, to_move, weights, board_size, n_in_row, n_games, seed, chunk = task
+  uniforms = _rollout_uniforms(seed, chunk, n_games, board_size)
+  winners = np.empty(n_games, dtype=np.int8)
+  lengths = np.empty(n_games, dtype=np.int16)
+  kernel.playouts(pieces, owners, po_left, to_move, weights, uniforms, board_size, n_in_row, winners, lengths, np.empty((0, 0), dtype=np.int16))
+  return winners, lengths
+
+
 class Board:
   def __init__(self):
     self.max_pieces_per_spot_on_board = 2
@@ -60,6 +121,13 @@ class Board:
 
   def empty_board(self) -> None:
     self.board = [ [Piece(t_Piece.EMPTY) for _ in range(self.max_pieces_per_spot_on_board)] for _ in range(self.board_size**self.max_pieces_per_spot_on_board) ]
+    # array mirror of self.board for the rules kernel, kept in sync by __setitem__
+    self.pieces, self.owners = kernel.new_board(self.board_size)
+
+  def _sync_slot(self, indx: int, slot: int) -> None:
+    piece = self.board[indx][slot]
+    self.pieces[indx, slot] = piece._typename.value
+    self.owners[indx, slot] = PLAYER_INDEX.get(piece.player_id, kernel.NO_OWNER)
 
   def convert_xy_to_indx(self, x: int, y: int) -> int:
     """Converts (x,y) cordinates to an index on the board"""
@@ -70,13 +138,14 @@ class Board:
     indx = self.convert_xy_to_indx(x, y)
     if isinstance(value, list):
       self.board[indx] = value
+      for slot in range(self.max_pieces_per_spot_on_board):
+        self._sync_slot(indx, slot)
     elif isinstance(value, Piece):
       # pi's go on the left and everything else
       # on the right for rendering purposes
-      if value._typename == t_Piece.PI:
-        self.board[indx][0] = value
-      else:
-        self.board[indx][1] = value
+      slot = 0 if value._typename == t_Piece.PI else 1
+      self.board[indx][slot] = value
+      self._sync_slot(indx, slot)
 
   def __getitem__(self, key):
     x, y = key
@@ -85,16 +154,16 @@ class Board:
 
   def __repr__(self) -> str:
     """Renders the board to the console"""
-    tmp = "   |0 ||1 ||2 ||3 ||4 ||5 ||6 || 7|\n\n"
+    # collect the pieces and join once instead of growing a string cell by cell
+    parts = ["   |0 ||1 ||2 ||3 ||4 ||5 ||6 || 7|\n\n"]
     for y in reversed(range(self.board_size)):  # Iterate in reverse for correct orientation
-        tmp += f"{y}| "
+        parts.append(f"{y}| ")
         for x in range(self.board_size):
-          indx = self.convert_xy_to_indx(x, y)
-          l, r = self.board[indx]
-          tmp += f"|{l.to_str()}{r.to_str()}|"
-        tmp += "\n"
-    tmp += "\n"
-    return tmp
+          l, r = self.board[self.convert_xy_to_indx(x, y)]
+          parts.append(f"|{l.to_str()}{r.to_str()}|")
+        parts.append("\n")
+    parts.append("\n")
+    return "".join(parts)
 
 
 class Game:
@@ -153,10 +222,86 @@ class Game:
     if piece._typename == t_Piece.PO: # decrement player PO count
         self.po_per_player[player_id] = self.po_per_player[player_id] - 1
 
+  def action_mask(self, player_id: str, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Returns (or writes into `out`) a 0/1 int8 mask over the 3*64 actions, in the
+    order PePiPoEnv.parse_piece_from_action decodes them. Uses the rules kernel.
+    """
+    if out is None:
+      out = np.zeros(len(kernel.ACTION_PIECES) * self.board.board_size**2, dtype=np.int8)
+    kernel.action_mask(self.board.pieces, self.po_per_player[player_id], self.board.board_size, out)
+    return out
+
+  def is_winning_move(self, x: int, y: int, player_id: str) -> bool:
+    """Returns True if the piece player_id just placed at (x, y) completed a row.
+    Equivalent to check_winner right after a move, but only looks at the lines through (x, y).
+    """
+    won = kernel.wins_through(self.board.owners, x, y, PLAYER_INDEX[player_id], self.board.board_size, self.n_pieces_in_a_row_to_win)
+    if won and self.verbose: print(f"is_winning_move({x}, {y}, {player_id}) won")
+    return won
+
+  def rollout(self, player_id: str, n_games: int = 1, weights: tuple[float, float, float] = (1.0, 1.0, 1.0), seed: Optional[int] = None, n_workers: int = 1) -> RolloutStats:
+    """Plays n_games random games to completion from the current position with player_id to move.
+    Legal moves are drawn with probability proportional to the weight of their piece (PI, PE, PO).
+    Runs on the rules kernel without touching the board, across n_workers processes if > 1.
+    """
+    assert n_games > 0, f"Rollouts need at least one game, not {n_games}"
+    assert all(w > 0 for w in weights), f"Rollout weights must be positive, not {weights}"
+    if seed is None:
+      seed = int(np.random.SeedSequence().entropy) # recorded in the stats so games can be replayed
+    player_ids = [f"player_{i}" for i in range(self.n_players)]
+    chunk_sizes = [min(ROLLOUT_CHUNK_SIZE, n_games - i) for i in range(0, n_games, ROLLOUT_CHUNK_SIZE)]
+    tasks = [
+      (self.board.pieces, self.board.owners, self.po_left(), PLAYER_INDEX[player_id], np.asarray(weights, dtype=np.float64),
+       self.board.board_size, self.n_pieces_in_a_row_to_win, n, seed, chunk)
+      for chunk, n in enumerate(chunk_sizes)
+    ]
+    if n_workers > 1 and len(tasks) > 1:
+      with mp.Pool(min(n_workers, len(tasks))) as pool:
+        results = pool.map(_rollout_chunk, tasks)
+    else:
+      results = [_rollout_chunk(t) for t in tasks]
+    return RolloutStats(
+      player_ids=player_ids,
+      winners=np.concatenate([w for w, _ in results]),
+      lengths=np.concatenate([l for _, l in results]),
+      seed=seed,
+    )
+
+  def replay_rollout(self, player_id: str, game_id: int, seed: int, weights: tuple[float, float, float] = (1.0, 1.0, 1.0)) -> tuple[Optional[str], list[tuple[t_Piece, int, int]]]:
+    """Plays game `game_id` of a rollout(player_id, seed=seed, weights=weights) from this position again.
+    Returns the winner (None on a tie) and the moves played as (piece, x, y).
+    """
+    size = self.board.board_size
+    chunk, row = divmod(game_id, ROLLOUT_CHUNK_SIZE)
+    uniforms = _rollout_uniforms(seed, chunk, row + 1, size)[row:]
+    winners = np.empty(1, dtype=np.int8)
+    lengths = np.empty(1, dtype=np.int16)
+    actions = np.empty((1, 2 * size * size), dtype=np.int16)
+    kernel.playouts(self.board.pieces, self.board.owners, self.po_left(), PLAYER_INDEX[player_id], np.asarray(weights, dtype=np.float64),
+                    uniforms, size, self.n_pieces_in_a_row_to_win, winners, lengths, actions)
+    moves = []
+    for action in actions[0, :lengths[0]]:
+      block, indx = divmod(int(action), size * size)
+      moves.append((t_Piece(kernel.ACTION_PIECES[block]), indx // size, indx % size))
+    winner = None if winners[0] == kernel.NO_OWNER else f"player_{winners[0]}"
+    return winner, moves
+
+  def po_left(self, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Returns (or writes into `out`) the remaining POs of every player as int16, indexed like PLAYER_INDEX."""
+    if out is None:
+      out = np.empty(self.n_players, dtype=np.int16)
+    for i in range(self.n_players):
+      out[i] = self.po_per_player.get(f"player_{i}", self.max_pos_per_player)
+    return out
+
   def check_tie(self, player_id: str) -> bool:
     """Returns True if there is no more valid moves, False if not.
     There is a tie game if there are no more valid moves left on the board.
     """
+    return not kernel.has_valid_move(self.board.pieces)
+
+  def check_tie_reference(self, player_id: str) -> bool:
+    """Pure Python version of check_tie, kept to cross-check the kernel."""
     for x in range(self.board.board_size):
         for y in range(self.board.board_size):
             for p in (t_Piece.PE, t_Piece.PI, t_Piece.PO):
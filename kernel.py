@@ -0,0 +1,322 @@
+"""Array based rules kernel.
+
+The board is stored as two (board_size**2, 2) int8 arrays indexed like
+`Board.board`: `pieces` holds the t_Piece value of each slot and `owners` the
+index of the player that owns it (NO_OWNER when empty). Slot 0 holds PIs and
+slot 1 everything else.
+
+The functions here are compiled with Numba when it is installed and run as
+plain Python otherwise (or when PEPIPO_DISABLE_JIT is set). Numba is only
+imported the first time a kernel function is called, so importing the rules
+engine stays cheap. `Game` keeps its original Python rules as the reference
+implementation; test.py cross-checks the two.
+"""
+from functools import wraps
+from importlib.util import find_spec
+import os
+
+import numpy as np
+
+HAS_NUMBA = not os.environ.get("PEPIPO_DISABLE_JIT") and find_spec("numba") is not None
+BACKEND = "numba" if HAS_NUMBA else "python"
+
+_jit_names: list[str] = []
+_compiled = False
+
+
+def jit(fn):
+    """Marks a kernel function for compilation.
+
+    Until the first kernel call the module holds stubs; that call imports Numba
+    and replaces every marked function with its compiled version (so compiled
+    functions call each other directly). Stubs keep forwarding to the compiled
+    version for callers that imported them by name.
+    """
+    if not HAS_NUMBA:
+        return fn
+    _jit_names.append(fn.__name__)
+
+    @wraps(fn)
+    def stub(*args):
+        _compile_kernel()
+        return globals()[fn.__name__](*args)
+    stub.py_func = fn # same attribute as numba dispatchers
+    return stub
+
+
+def _compile_kernel() -> None:
+    global _compiled, BACKEND
+    if _compiled:
+        return
+    module = globals()
+    try:
+        from numba import njit
+    except ImportError: # installed but broken, e.g. built against another numpy
+        for name in _jit_names:
+            module[name] = module[name].py_func
+        BACKEND = "python"
+    else:
+        for name in _jit_names:
+            module[name] = njit(cache=True)(module[name].py_func)
+    _compiled = True
+
+
+# mirrors t_Piece values
+EMPTY = 0
+PI = 1
+PE = 2
+PO = 3
+
+NO_OWNER = -1
+PI_SLOT = 0
+TOP_SLOT = 1
+
+# action = block * board_size**2 + x * board_size + y, blocks in this order
+ACTION_PIECES = (PI, PE, PO)
+
+
+def new_board(board_size: int) -> tuple[np.ndarray, np.ndarray]:
+    """Returns empty (pieces, owners) arrays for a board_size x board_size board."""
+    pieces = np.full((board_size * board_size, 2), EMPTY, dtype=np.int8)
+    owners = np.full((board_size * board_size, 2), NO_OWNER, dtype=np.int8)
+    return pieces, owners
+
+
+@jit
+def is_valid_move(pieces, x, y, piece, po_left, board_size) -> bool:
+    """Same rules as Game.validate_move, `po_left` is the mover's remaining PO count."""
+    if x < 0 or x >= board_size or y < 0 or y >= board_size:
+        return False
+    cell = x + y * board_size
+    top = pieces[cell, TOP_SLOT]
+    if piece == PE:
+        return top == EMPTY
+    if piece == PO:
+        return top == EMPTY and po_left > 0
+    if piece == PI:
+        return top == PE and pieces[cell, PI_SLOT] == EMPTY
+    return False
+
+
+@jit
+def place(pieces, owners, x, y, piece, player, board_size) -> None:
+    """Same as Game.make_move minus the PO bookkeeping, which stays with the caller."""
+    cell = x + y * board_size
+    slot = PI_SLOT if piece == PI else TOP_SLOT
+    pieces[cell, slot] = piece
+    owners[cell, slot] = player
+
+
+@jit
+def action_mask(pieces, po_left, board_size, out) -> None:
+    """Writes 1 into `out` for every legal action and 0 for every illegal one."""
+    n_cells = board_size * board_size
+    for x in range(board_size):
+        for y in range(board_size):
+            cell = x + y * board_size
+            a = x * board_size + y
+            top = pieces[cell, TOP_SLOT]
+            out[a] = 1 if top == PE and pieces[cell, PI_SLOT] == EMPTY else 0
+            out[n_cells + a] = 1 if top == EMPTY else 0
+            out[2 * n_cells + a] = 1 if top == EMPTY and po_left > 0 else 0
+
+
+@jit
+def has_valid_move(pieces) -> bool:
+    """Same as `not Game.check_tie`. A PO is never legal where a PE is not, so the PO count does not matter."""
+    for cell in range(pieces.shape[0]):
+        top = pieces[cell, TOP_SLOT]
+        if top == EMPTY or (top == PE and pieces[cell, PI_SLOT] == EMPTY):
+            return True
+    return False
+
+
+@jit
+def _occupies(owners, x, y, player, board_size) -> bool:
+    cell = x + y * board_size
+    return owners[cell, PI_SLOT] == player or owners[cell, TOP_SLOT] == player
+
+
+@jit
+def _run_length(owners, x, y, dx, dy, player, board_size) -> int:
+    """Number of consecutive cells after (x, y) in direction (dx, dy) that `player` occupies."""
+    n = 0
+    x += dx
+    y += dy
+    while 0 <= x < board_size and 0 <= y < board_size and _occupies(owners, x, y, player, board_size):
+        n += 1
+        x += dx
+        y += dy
+    return n
+
+
+@jit
+def wins_through(owners, x, y, player, board_size, n_in_row) -> bool:
+    """True if `player` has n_in_row in a line passing through (x, y).
+    Placing a piece only changes the placing player's occupancy of that one
+    cell, so checking the lines through the last move is enough to detect a win.
+    """
+    if not _occupies(owners, x, y, player, board_size):
+        return False
+    for dx, dy in ((1, 0), (0, 1), (1, 1), (1, -1)):
+        if 1 + _run_length(owners, x, y, dx, dy, player, board_size) + _run_length(owners, x, y, -dx, -dy, player, board_size) >= n_in_row:
+            return True
+    return False
+
+
+@jit
+def is_winner(owners, player, board_size, n_in_row) -> bool:
+    """Same as Game.check_winner: scans the whole board for n_in_row."""
+    for y in range(board_size):
+        for x in range(board_size):
+            if not _occupies(owners, x, y, player, board_size):
+                continue
+            # only count runs from their first cell
+            for dx, dy in ((1, 0), (0, 1), (1, 1), (1, -1)):
+                px, py = x - dx, y - dy
+                if 0 <= px < board_size and 0 <= py < board_size and _occupies(owners, px, py, player, board_size):
+                    continue
+                if 1 + _run_length(owners, x, y, dx, dy, player, board_size) >= n_in_row:
+                    return True
+    return False
+
+
+@jit
+def playouts(pieces, owners, po_left, to_move, weights, uniforms, board_size, n_in_row, winners, lengths, actions) -> None:
+    """Plays uniforms.shape[0] random games to completion from the given position.
+
+    `po_left` holds the remaining PO count of every player and `to_move` the
+    index of the player to move. Legal actions are drawn with probability
+    proportional to `weights[block]` (blocks in ACTION_PIECES order) using one
+    row of `uniforms` per game, so a game needs at most 2 * board_size**2
+    numbers. Writes the winning player index (NO_OWNER on a tie) and the number
+    of moves of every game into `winners` and `lengths`, and, when `actions`
+    has a row per game, every action played into it. The input position is
+    not modified.
+    """
+    record = actions.shape[0] > 0
+    n_cells = board_size * board_size
+    n_players = po_left.shape[0]
+    mask = np.zeros(len(ACTION_PIECES) * n_cells, dtype=np.int8)
+    for g in range(uniforms.shape[0]):
+        p = pieces.copy()
+        o = owners.copy()
+        po = po_left.copy()
+        player = to_move
+        winners[g] = NO_OWNER
+        n = 0
+        while has_valid_move(p):
+            action_mask(p, po[player], board_size, mask)
+            total = 0.0
+            for a in range(mask.shape[0]):
+                if mask[a]:
+                    total += weights[a // n_cells]
+            target = uniforms[g, n] * total
+            chosen = -1
+            for a in range(mask.shape[0]):
+                if mask[a]:
+                    chosen = a
+                    target -= weights[a // n_cells]
+                    if target < 0:
+                        break
+            if record:
+                actions[g, n] = chosen
+            piece = ACTION_PIECES[chosen // n_cells]
+            x = (chosen % n_cells) // board_size
+            y = (chosen % n_cells) % board_size
+            place(p, o, x, y, piece, player, board_size)
+            if piece == PO:
+                po[player] -= 1
+            n += 1
+            if wins_through(o, x, y, player, board_size, n_in_row):
+                winners[g] = player
+                break
+            player = (player + 1) % n_players
+        lengths[g] = n
+
+
+@jit
+def _open_for(pieces, owners, cell, player) -> bool:
+    """True if `player` occupies `cell` or can still place a piece in it."""
+    if owners[cell, PI_SLOT] == player or owners[cell, TOP_SLOT] == player:
+        return True
+    top = pieces[cell, TOP_SLOT]
+    return top == EMPTY or (top == PE and pieces[cell, PI_SLOT] == EMPTY)
+
+
+@jit
+def threat_counts(pieces, owners, x, y, board_size, n_in_row, out) -> None:
+    """Counts, for every player, the open lines of n_in_row cells through (x, y).
+
+    A line is open for a player while every cell in it is either theirs or can
+    still take one of their pieces. out[player, 0] gets the open lines holding
+    at least n_in_row - 2 of the player's pieces and out[player, 1] those
+    holding at least n_in_row - 1. Only lines through (x, y) change when a
+    piece is placed there, so the difference of these counts before and after
+    a move is the change over the whole board.
+    """
+    out[:] = 0
+    for player in range(out.shape[0]):
+        for dx, dy in ((1, 0), (0, 1), (1, 1), (1, -1)):
+            # windows start up to n_in_row - 1 cells before (x, y)
+            for back in range(n_in_row):
+                sx = x - back * dx
+                sy = y - back * dy
+                ex = sx + (n_in_row - 1) * dx
+                ey = sy + (n_in_row - 1) * dy
+                if not (0 <= sx < board_size and 0 <= sy < board_size and 0 <= ex < board_size and 0 <= ey < board_size):
+                    continue
+                n_mine = 0
+                is_open = True
+                for i in range(n_in_row):
+                    cell = (sx + i * dx) + (sy + i * dy) * board_size
+                    if not _open_for(pieces, owners, cell, player):
+                        is_open = False
+                        break
+                    if owners[cell, PI_SLOT] == player or owners[cell, TOP_SLOT] == player:
+                        n_mine += 1
+                if is_open:
+                    if n_mine >= n_in_row - 2:
+                        out[player, 0] += 1
+                    if n_mine >= n_in_row - 1:
+                        out[player, 1] += 1
+
+
+@jit
+def encode_planes(pieces, owners, me, po_left, max_po, is_to_move, last_x, last_y, use_po_counts, use_side_to_move, use_last_move, board_size, out) -> None:
+    """Writes the channel-first planes observation of player `me` into `out`.
+
+    Players are ordered from `me` onwards. Every player gets a PE, PI and PO
+    plane, followed (when enabled) by one PO count plane per player filled
+    with po_left / max_po, a side to move plane and a last move plane
+    (last_x < 0 when there is no last move). out[c, x, y] describes (x, y).
+    """
+    n_players = po_left.shape[0]
+    out[:] = 0
+    for x in range(board_size):
+        for y in range(board_size):
+            cell = x + y * board_size
+            for slot in range(2):
+                owner = owners[cell, slot]
+                if owner == NO_OWNER:
+                    continue
+                rel = (owner - me) % n_players
+                piece = pieces[cell, slot]
+                # PE, PI, PO planes of the owner
+                if piece == PE:
+                    out[3 * rel, x, y] = 1
+                elif piece == PI:
+                    out[3 * rel + 1, x, y] = 1
+                elif piece == PO:
+                    out[3 * rel + 2, x, y] = 1
+    c = 3 * n_players
+    if use_po_counts:
+        for rel in range(n_players):
+            out[c] = po_left[(me + rel) % n_players] / max_po
+            c += 1
+    if use_side_to_move:
+        if is_to_move:
+            out[c] = 1
+        c += 1
+    if use_last_move and last_x >= 0:
+        out[c, last_x, last_y] = 1
@@ -0,0 +1,198 @@
+"""Throughput and memory monitor for long training runs.
+
+ThroughputMonitor.sample() records env steps/sec, episodes/sec, process RSS and
+garbage collector pauses since the previous sample and logs them through a
+tianshou logger. It can also fail the run when throughput drops or memory grows
+past the configured thresholds, and take tracemalloc snapshots on demand to
+find what is allocating.
+"""
+import gc
+import os
+import signal
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import Optional
+
+
+class RegressionError(RuntimeError):
+    """Raised by ThroughputMonitor when a sample breaks one of its thresholds."""
+
+
+@dataclass
+class MonitorThresholds:
+    """Limits checked on every sample after the baseline. 0 disables a check."""
+    max_throughput_drop: float = 0.0  # fraction of the baseline steps/sec, e.g. 0.3 fails below 70% of it
+    max_rss_growth_mb: float = 0.0    # RSS growth over the baseline, in MB
+    min_steps_per_sec: float = 0.0
+
+
+def current_rss_bytes() -> int:
+    """Resident set size of this process, or its peak RSS where the current one is not available."""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if os.uname().sysname == "Darwin" else peak * 1024 # bytes on macOS, KB elsewhere
+
+
+class ThroughputMonitor:
+    """Samples throughput, memory and GC pauses of the training process.
+
+    The first `warmup_samples` samples are logged but neither become the
+    baseline nor get checked (they cover process start, imports, JIT
+    compilation and buffer allocation); the next one is the baseline. With
+    `fail_on_regression` a broken threshold raises RegressionError, otherwise
+    it is only printed.
+    """
+
+    def __init__(
+        self,
+        logger=None,
+        thresholds: Optional[MonitorThresholds] = None,
+        fail_on_regression: bool = False,
+        warmup_samples: int = 1,
+        interval: float = 0.0,
+    ) -> None:
+        self.logger = logger
+        self.thresholds = thresholds if thresholds is not None else MonitorThresholds()
+        self.fail_on_regression = fail_on_regression
+        self.warmup_samples = warmup_samples
+        self.interval = interval
+
+        self.n_samples = 0
+        self.baseline: Optional[dict] = None
+        self.last: Optional[dict] = None
+        self.violations: list[str] = []
+        self._rss_baseline: dict[str, float] = {}
+
+        self.gc_pause = 0.0
+        self.gc_collections = [0, 0, 0]
+        self._gc_start = 0.0
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+
+    # ======== gc pauses =========
+    def _on_gc(self, phase: str, info: dict) -> None:
+        if phase == "start":
+            self._gc_start = time.perf_counter()
+        else:
+            self.gc_pause += time.perf_counter() - self._gc_start
+            self.gc_collections[info["generation"]] += 1
+
+    def start(self, env_step: int = 0, n_episodes: int = 0) -> None:
+        gc.callbacks.append(self._on_gc)
+        self.last = {"time": time.perf_counter(), "env_step": env_step, "n_episodes": n_episodes, "gc_pause": self.gc_pause}
+
+    def stop(self) -> None:
+        if self._on_gc in gc.callbacks:
+            gc.callbacks.remove(self._on_gc)
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    # ======== sampling =========
+    def sample(self, env_step: int, n_episodes: int, worker_rss: Optional[dict] = None, force: bool = False) -> Optional[dict]:
+        """Records a sample at `env_step`. Returns None when called again within `interval` seconds (unless forced).
+
+        `worker_rss` maps the name of other processes doing the work (e.g. actors)
+        to their latest RSS in bytes; they are logged and checked like this process.
+        """
+        if self.last is None:
+            self.start(env_step, n_episodes)
+            return None
+        now = time.perf_counter()
+        elapsed = now - self.last["time"]
+        if elapsed <= 0 or (elapsed < self.interval and not force):
+            return None
+
+        data = {
+            "monitor/steps_per_sec": (env_step - self.last["env_step"]) / elapsed,
+            "monitor/episodes_per_sec": (n_episodes - self.last["n_episodes"]) / elapsed,
+            "monitor/rss_mb": current_rss_bytes() / 2**20,
+            **{f"monitor/{name}_rss_mb": rss / 2**20 for name, rss in (worker_rss or {}).items()},
+            "monitor/gc_pause_frac": (self.gc_pause - self.last["gc_pause"]) / elapsed,
+            "monitor/gc_pause_total": self.gc_pause,
+            **{f"monitor/gc_collections_gen{i}": n for i, n in enumerate(self.gc_collections)},
+        }
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            data["monitor/traced_mb"] = current / 2**20
+            data["monitor/traced_peak_mb"] = peak / 2**20
+        self.last = {"time": now, "env_step": env_step, "n_episodes": n_episodes, "gc_pause": self.gc_pause}
+        self.n_samples += 1
+
+        if self.logger is not None:
+            self.logger.write("monitor/env_step", env_step, data)
+        if self.n_samples == self.warmup_samples + 1:
+            self.baseline = data
+        if self.baseline is not None:
+            # workers that report after the baseline get theirs from their first report
+            for key, rss in data.items():
+                if key.endswith("rss_mb"):
+                    self._rss_baseline.setdefault(key, rss)
+            if self.baseline is not data:
+                self._check(data, env_step)
+        return data
+
+    def _check(self, data: dict, env_step: int) -> None:
+        t = self.thresholds
+        problems = []
+        steps_per_sec, baseline_steps = data["monitor/steps_per_sec"], self.baseline["monitor/steps_per_sec"]
+        if t.max_throughput_drop and steps_per_sec < (1 - t.max_throughput_drop) * baseline_steps:
+            problems.append(f"throughput dropped to {steps_per_sec:.1f} steps/s from a baseline of {baseline_steps:.1f}")
+        if t.min_steps_per_sec and steps_per_sec < t.min_steps_per_sec:
+            problems.append(f"throughput {steps_per_sec:.1f} steps/s is below {t.min_steps_per_sec}")
+        for key, baseline_rss in self._rss_baseline.items():
+            growth = data.get(key, baseline_rss) - baseline_rss
+            if t.max_rss_growth_mb and growth > t.max_rss_growth_mb:
+                name = key[len("monitor/"):-len("rss_mb")].rstrip("_") or "main process"
+                problems.append(f"{name} RSS grew by {growth:.1f}MB, more than {t.max_rss_growth_mb}MB")
+        for problem in problems:
+            message = f"env_step {env_step}: {problem}"
+            self.violations.append(message)
+            if self.fail_on_regression:
+                raise RegressionError(message)
+            print(f"WARNING {message}")
+
+    # ======== allocations =========
+    def snapshot_allocations(self, limit: int = 10) -> list[str]:
+        """Takes a tracemalloc snapshot and returns the `limit` source lines whose
+        allocations grew the most since the previous snapshot (or the largest ones
+        for the first snapshot). Starts tracing on the first call.
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ])
+        if self._snapshot is None:
+            stats = [str(s) for s in snapshot.statistics("lineno")[:limit]]
+        else:
+            stats = [str(s) for s in snapshot.compare_to(self._snapshot, "lineno")[:limit]]
+        self._snapshot = snapshot
+        return stats
+
+    def dump_allocations_on_signal(self, path: str, signum: Optional[int] = None) -> None:
+        """Appends an allocation snapshot to `path` whenever the process gets `signum`
+        (SIGUSR1 by default, e.g. `kill -USR1 <pid>` on a running job). Tracing
+        starts now, so the first dump already covers everything allocated since.
+        """
+        if signum is None:
+            if not hasattr(signal, "SIGUSR1"):
+                raise ValueError("SIGUSR1 is not available on this platform, pass the signal to dump allocations on")
+            signum = signal.SIGUSR1
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        def handler(signum, frame):
+            with open(path, "a") as f:
+                f.write(f"==== {time.strftime('%Y-%m-%d %H:%M:%S')} env_step {self.last['env_step'] if self.last else 0}\n")
+                f.write("\n".join(self.snapshot_allocations()) + "\n")
+        signal.signal(signum, handler)
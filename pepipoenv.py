@@ -1,10 +1,15 @@
-from game import Game, t_Piece, Piece, Colors
+from game import Game, t_Piece, PLAYER_INDEX
+from encoder import PlanesConfig, encode_planes
+import kernel
+from seeding import ENV_ACTION_SPACES, derive_seed
+
+from dataclasses import dataclass
+from typing import Optional
 
 from gymnasium import spaces
 import numpy as np
 from pettingzoo import AECEnv
 from pettingzoo.utils import agent_selector
-import pygame
 
 
 PLAYER_COLOR_MAP = {
@@ -13,6 +18,31 @@ PLAYER_COLOR_MAP = {
    "player_2": (255, 0, 0),
    "player_3": (255, 0, 255)
 }
+GRID_COLOR = (60, 60, 60)
+CELL_SIZE = 100 # pixels per board spot
+
+@dataclass
+class RewardShaping:
+    """Weights of the shaped reward terms added to the mover's reward on every step.
+
+    open3 / open4: change in the mover's open lines with 3+ / 4+ of their pieces
+    block3 / block4: opponents' open lines with 3+ / 4+ pieces closed by the move
+    po_spent: 1 when the move placed a PO (use a negative weight to save POs)
+
+    Terms with a weight of 0 are skipped unless `aux_targets` is set, in which
+    case every term is computed and reported in infos[agent]["aux"].
+    """
+    open3: float = 0.0
+    open4: float = 0.0
+    block3: float = 0.0
+    block4: float = 0.0
+    po_spent: float = 0.0
+    aux_targets: bool = False
+
+    def active_terms(self) -> list[str]:
+        terms = ["open3", "open4", "block3", "block4", "po_spent"]
+        return terms if self.aux_targets else [t for t in terms if getattr(self, t) != 0]
+
 
 class PePiPoEnv(AECEnv):
 
@@ -20,11 +50,37 @@ class PePiPoEnv(AECEnv):
         "name": "pepipo_0v",
         "is_parallelizable": False,
         "render_fps": 10,
-        "render_modes": ["human", "ascii"],
+        "render_modes": ["human", "ascii", "rgb_array"],
     }
 
-    def __init__(self, render_mode: str = "ascii", verbose: bool = False) -> None:
+    def __init__(
+        self,
+        render_mode: str = "ascii",
+        verbose: bool = False,
+        reward_shaping: Optional[RewardShaping] = None,
+        obs_type: str = "category",
+        planes_config: Optional[PlanesConfig] = None,
+        reuse_obs_buffers: bool = False,
+    ) -> None:
+        """
+        obs_type: "category" for the 8x8x1 int8 cell categories (see _get_obs_v2)
+            or "planes" for the channel-first float32 planes of encoder.encode_planes.
+        reuse_obs_buffers: with "planes", observe() writes into one buffer per agent
+            and returns it, so callers that keep observations around must copy them.
+        """
+        assert obs_type in ("category", "planes"), f"Unknown obs_type {obs_type}"
         self.game: Game = Game(verbose=verbose)
+        self.obs_type = obs_type
+        self.planes_config = planes_config if planes_config is not None else PlanesConfig()
+        self.reuse_obs_buffers = reuse_obs_buffers
+        self._last_move: Optional[tuple[int, int]] = None
+
+        # shaped rewards / auxiliary targets, None keeps the plain +1/-1 win reward
+        self.reward_shaping = reward_shaping
+        self._shaping_terms = reward_shaping.active_terms() if reward_shaping is not None else []
+        self._needs_threats = any(t != "po_spent" for t in self._shaping_terms)
+        self._threats_before = np.zeros((self.game.n_players, 2), dtype=np.int16)
+        self._threats_after = np.zeros((self.game.n_players, 2), dtype=np.int16)
 
         # AEC API
         self.agents = [f"player_{p}" for p in range(self.game.n_players)]
@@ -48,18 +104,32 @@ class PePiPoEnv(AECEnv):
         # obs space
         # 8x8x4
         # Not sure why I have to make the obs space a dict, this was how the connect_four env is (and other classic pz envs)
+        if self.obs_type == "planes":
+            board_space = spaces.Box(low=0, high=1, shape=self.planes_config.shape(self.game.n_players, self.game.board.board_size), dtype=np.float32)
+        else:
+            board_space = spaces.Box(low=0, high=7, shape=(self.game.board.board_size, self.game.board.board_size, 1), dtype=np.int8)
+        self._planes_buffers = {i: np.zeros(board_space.shape, dtype=np.float32) for i in self.agents} if self.obs_type == "planes" else {}
+        self._po_left_buffer = np.empty(self.game.n_players, dtype=np.int16)
         self.observation_spaces = {
             i: spaces.Dict({
-                "observation": spaces.Box(low=0, high=7, shape=(self.game.board.board_size, self.game.board.board_size, 1), dtype=np.int8),
+                "observation": board_space,
                 "action_mask": spaces.Box(low=0, high=1, shape=(len(valid_piece_types)*total_spots_on_board,), dtype=np.int8)
             }) for i in self.agents
         }
 
         self.render_mode = render_mode
 
+        # "human" and "rgb_array" draw onto an off-screen canvas, only redrawing
+        # the cells in self._dirty_cells; "human" then copies it to the window
+        self._board_surface = None
+        self._canvas = None
+        self._dirty_cells: list[tuple[int, int]] = []
+
         if self.render_mode == "human":
+            import pygame # only needed for rendering, keep it out of headless workers
             pygame.init()
-            self.screen = pygame.display.set_mode((800, 800))
+            size = self.game.board.board_size * CELL_SIZE
+            self.screen = pygame.display.set_mode((size, size))
             self.clock = pygame.time.Clock()
             pygame.display.set_caption("PePiPo")
 
@@ -82,7 +152,17 @@ class PePiPoEnv(AECEnv):
         return piece_type, x, y
 
     def observe(self, agent) -> dict:
+        if self.obs_type == "planes":
+            return {"observation": self._get_obs_planes(agent), "action_mask": self._get_action_mask(agent)}
         return {"observation": self._get_obs_v2(agent), "action_mask": self._get_action_mask(agent)}
+
+    def _get_obs_planes(self, agent) -> np.ndarray:
+        """Channel-first planes observation, see encoder.encode_planes."""
+        if self.reuse_obs_buffers:
+            out, po_left = self._planes_buffers[agent], self._po_left_buffer
+        else:
+            out, po_left = np.empty(self.observation_spaces[agent]["observation"].shape, dtype=np.float32), None
+        return encode_planes(self.game, agent, out, self.planes_config, to_move=self.agent_selection, last_move=self._last_move, po_left=po_left)
     
     def _get_obs_v2(self, agent) -> np.ndarray:
         """Generates the observation from the state (board). ONLY WORKS FOR 2 PLAYERS"""
@@ -148,13 +228,8 @@ class PePiPoEnv(AECEnv):
         return self.observation_spaces[agent]
 
     def _get_action_mask(self, agent) -> np.ndarray:
-        mask = np.zeros(shape=(3*64), dtype=np.int8)
-        # iterate through all possible actions
-        # and mark 1 if legal and 0 if illegal
-        for action in range(3*64):
-            piece_type, x, y = self.parse_piece_from_action(action)
-            mask[action] = 1 if self.game.validate_move(x, y, piece_type, agent) else 0
-        return mask
+        # 1 if legal and 0 if illegal, computed by the rules kernel
+        return self.game.action_mask(agent)
 
     def action_space(self, agent):
         return self.action_spaces[agent]
@@ -183,19 +258,34 @@ class PePiPoEnv(AECEnv):
         # validate move
         assert self.game.validate_move(x, y, piece_type, agent)
 
+        # only the lines through (x, y) change, so shaping looks at them before and after the move
+        if self._needs_threats:
+            kernel.threat_counts(self.game.board.pieces, self.game.board.owners, x, y, self.game.board.board_size, self.game.n_pieces_in_a_row_to_win, self._threats_before)
+
         # make move
         self.game.make_move(x, y, piece_type, agent)
+        self._last_move = (x, y)
+        self._dirty_cells.append((x, y))
+
+        if self._shaping_terms:
+            shaped_reward = self._shape_reward(agent, x, y, piece_type)
+            self.rewards = {i: 0 for i in self.agents}
+            self.rewards[agent] = shaped_reward
 
-        # check winner
-        if self.game.check_winner(agent):
+        # check winner (only the lines through the piece just placed can have changed)
+        if self.game.is_winning_move(x, y, agent):
             # print(f"{agent} won!")
             self.rewards = {i: -1 for i in self.agents}
             self.rewards[self.agent_selection] = 1  # winner gets +1 reward, loser gets -1
+            if self._shaping_terms:
+                self.rewards[agent] += shaped_reward
             self.terminations = {i: True for i in self.agents}
             self.truncations = {i: True for i in self.agents}
         elif self.game.check_tie(agent):
             # print('Tie!')
             self.rewards = {i: 0 for i in self.agents} # 0 reward for all agents in a tie
+            if self._shaping_terms:
+                self.rewards[agent] += shaped_reward
             self.terminations = {i: True for i in self.agents}
             self.truncations = {i: True for i in self.agents}
 
@@ -209,53 +299,106 @@ class PePiPoEnv(AECEnv):
         if self.render_mode == "human":
             self.render()
 
+    def _shape_reward(self, agent: str, x: int, y: int, piece_type: t_Piece) -> float:
+        """Computes the active shaping terms of the move just made into infos[agent]["aux"] and returns their weighted sum."""
+        if self._needs_threats:
+            kernel.threat_counts(self.game.board.pieces, self.game.board.owners, x, y, self.game.board.board_size, self.game.n_pieces_in_a_row_to_win, self._threats_after)
+        me = PLAYER_INDEX[agent]
+        delta = self._threats_after - self._threats_before
+        blocked = delta[me] - delta.sum(axis=0) # drop in the opponents' open lines
+        terms = {
+            "open3": int(delta[me, 0]),
+            "open4": int(delta[me, 1]),
+            "block3": int(blocked[0]),
+            "block4": int(blocked[1]),
+            "po_spent": int(piece_type == t_Piece.PO),
+        }
+        aux = {t: terms[t] for t in self._shaping_terms}
+        self.infos[agent]["aux"] = aux
+        return sum(getattr(self.reward_shaping, t) * v for t, v in aux.items())
+
     def reset(self, seed=None, options=None):
+        if seed is not None:
+            self._seed(seed)
         self.game = Game() # resets board
+        self._last_move = None
+        self._canvas = None # redrawn from the cached board surface on the next render
+        self._dirty_cells = []
         self.agents = self.possible_agents[:]
+        self._agent_selector.reinit(self.agents)
+        self.agent_selection = self._agent_selector.reset() # player_0 always moves first
         self.terminations = {i: False for i in self.agents}
         self.truncations = {i: False for i in self.agents}
         self.rewards = {i: 0 for i in self.agents}
         self.infos = {i: {} for i in self.agents}
         self._cumulative_rewards = {i: 0 for i in self.agents}
 
-    def render(self) -> None:
+    def _seed(self, seed: int) -> None:
+        """Gives every agent's action space its own stream derived from `seed`, so
+        action_space(agent).sample() replays exactly for the same seed. The game
+        itself is deterministic and needs no RNG.
+        """
+        for i, agent in enumerate(self.possible_agents):
+            self.action_spaces[agent].seed(derive_seed(seed, ENV_ACTION_SPACES, i))
+
+    def render(self) -> Optional[np.ndarray]:
         if self.render_mode == "ascii":
             self.game.print_board()
-        elif self.render_mode == "human":
-            # TODO: Add lines between each spot on the board
+        elif self.render_mode in ("human", "rgb_array"):
             # TODO: Display the current player (in their color?)
             # TODO: Display the winner
             # TODO: Display POs per player
-            self.screen.fill((0,0,0))
-            # pygame.draw.rect(self.screen, (139,69,19), pygame.Rect((100, 100), (800, 800))) # this will be the rendered 'board'
-
-
-            def draw_board_spot(center_coords: tuple[int, int], spot: list[Piece, Piece]) -> None:
-                """Draws the spot at the center coordinates"""
-                if spot[0]._typename == t_Piece.EMPTY and spot[1]._typename == t_Piece.EMPTY:
-                    return
-                for s in spot:
-                    if s._typename == t_Piece.PE:
-                        pygame.draw.circle(self.screen, PLAYER_COLOR_MAP[s.player_id], center_coords, 40, 10)
-                    elif s._typename == t_Piece.PI:
-                        pygame.draw.circle(self.screen, PLAYER_COLOR_MAP[s.player_id], center_coords, 20)
-                    elif s._typename == t_Piece.PO:
-                        pygame.draw.circle(self.screen, PLAYER_COLOR_MAP[s.player_id], center_coords, 40)
-
-            # x: [150:50:850], y: [150:50:850]
-            for x in range(self.game.board.board_size):
-                for y in range(self.game.board.board_size):
-                    spot = self.game.board[x, y]
-                    canvas_coords = ((x * 100) + 50, (y * 100) + 50)
-                    draw_board_spot(canvas_coords, spot)
-
-            pygame.display.flip()
-            pygame.display.update()
-            self.clock.tick(self.metadata["render_fps"])
-
+            import pygame
+            dirty_rects = self._draw_dirty_cells()
+            if self.render_mode == "rgb_array":
+                return np.transpose(pygame.surfarray.array3d(self._canvas), (1, 0, 2))
+            if dirty_rects: # nothing changed since the last frame, skip the flip and the frame delay
+                for rect in dirty_rects:
+                    self.screen.blit(self._canvas, rect, rect)
+                pygame.display.update(dirty_rects)
+                self.clock.tick(self.metadata["render_fps"])
+
+    def _get_board_surface(self) -> "pygame.Surface":
+        """The static board (background and grid lines), drawn once and cached."""
+        import pygame
+        if self._board_surface is None:
+            size = self.game.board.board_size * CELL_SIZE
+            self._board_surface = pygame.Surface((size, size))
+            self._board_surface.fill((0, 0, 0))
+            for i in range(1, self.game.board.board_size):
+                pygame.draw.line(self._board_surface, GRID_COLOR, (i * CELL_SIZE, 0), (i * CELL_SIZE, size))
+                pygame.draw.line(self._board_surface, GRID_COLOR, (0, i * CELL_SIZE), (size, i * CELL_SIZE))
+        return self._board_surface
+
+    def _draw_dirty_cells(self) -> list:
+        """Brings the canvas up to date by redrawing only the cells changed since the last render.
+        Returns the rects that were redrawn.
+        """
+        import pygame
+        board_surface = self._get_board_surface()
+        if self._canvas is None:
+            self._canvas = board_surface.copy()
+            self._dirty_cells = [(x, y) for x in range(self.game.board.board_size) for y in range(self.game.board.board_size)]
+
+        rects = []
+        for x, y in self._dirty_cells:
+            rect = pygame.Rect(x * CELL_SIZE, y * CELL_SIZE, CELL_SIZE, CELL_SIZE)
+            self._canvas.blit(board_surface, rect, rect)
+            center_coords = rect.center
+            for s in self.game.board[x, y]:
+                if s._typename == t_Piece.PE:
+                    pygame.draw.circle(self._canvas, PLAYER_COLOR_MAP[s.player_id], center_coords, 40, 10)
+                elif s._typename == t_Piece.PI:
+                    pygame.draw.circle(self._canvas, PLAYER_COLOR_MAP[s.player_id], center_coords, 20)
+                elif s._typename == t_Piece.PO:
+                    pygame.draw.circle(self._canvas, PLAYER_COLOR_MAP[s.player_id], center_coords, 40)
+            rects.append(rect)
+        self._dirty_cells = []
+        return rects
 
     def close(self) -> None:
         if self.render_mode == "human":
+            import pygame
             pygame.quit()
 
 
@@ -0,0 +1,35 @@
+"""Per-stream RNGs derived from one root seed.
+
+Every env, game or actor gets its own stream, identified by a path of ints
+under the root seed (e.g. (TRAIN_ENVS, env_index) or (game_id,)). The stream
+for a path is the same SeedSequence that `SeedSequence(root_seed).spawn()`
+would hand out along that path, so it can be rebuilt directly from its ids
+without replaying the rest of the run.
+"""
+from typing import Optional
+
+import numpy as np
+
+# first id of the stream paths used by train.py and actor_learner.py
+TRAIN_ENVS = 0
+TEST_ENVS = 1
+ACTORS = 2
+
+# first id of the stream paths PePiPoEnv derives from the seed given to reset(),
+# an id space separate from the one above (which hangs off a run's root seed)
+ENV_ACTION_SPACES = 0
+
+
+def seed_sequence(root_seed: Optional[int], *ids: int) -> np.random.SeedSequence:
+    """The SeedSequence of stream `ids` under root_seed."""
+    return np.random.SeedSequence(root_seed, spawn_key=tuple(ids))
+
+
+def make_rng(root_seed: Optional[int], *ids: int) -> np.random.Generator:
+    """A Generator for stream `ids` under root_seed."""
+    return np.random.default_rng(seed_sequence(root_seed, *ids))
+
+
+def derive_seed(root_seed: Optional[int], *ids: int) -> int:
+    """A 32 bit int seed for stream `ids`, for APIs that only take ints (env.reset, torch.manual_seed)."""
+    return int(seed_sequence(root_seed, *ids).generate_state(1)[0])
@@ -1,6 +1,8 @@
-from game import Game, Piece, t_Piece, Colors
-from pepipoenv import PePiPoEnv
+from game import Game, Piece, t_Piece, Colors, PLAYER_INDEX
+from pepipoenv import PePiPoEnv, RewardShaping
+import kernel
 
+import numpy as np
 import pytest
 
 
@@ -108,6 +110,103 @@ def test_piece_rules(game: Game):
     game.make_move(0, 0, t_Piece.PI, player)
     assert not game.validate_move(0, 0, t_Piece.PI, player), "Was able to place a PI on another PI"
 
+def check_kernel_against_reference(n_games: int) -> None:
+    """Plays random games and checks the kernel against Game's reference rules after every move."""
+    rng = np.random.default_rng(0)
+    actions = [(p, x, y) for p in (t_Piece.PI, t_Piece.PE, t_Piece.PO) for x in range(8) for y in range(8)]
+    for _ in range(n_games):
+        game = Game()
+        players = ["player_0", "player_1"]
+        turn = 0
+        while True:
+            player = players[turn % 2]
+            size = game.board.board_size
+            mask = np.zeros(3 * size * size, dtype=np.int8)
+            kernel.action_mask(game.board.pieces, game.po_per_player[player], size, mask)
+            expected = np.array([game.validate_move(x, y, p, player) for p, x, y in actions], dtype=np.int8)
+            assert np.array_equal(mask, expected), "Kernel action mask disagrees with validate_move"
+            for (p, x, y), legal in zip(actions, expected):
+                assert kernel.is_valid_move(game.board.pieces, x, y, p.value, game.po_per_player[player], size) == legal
+            assert kernel.has_valid_move(game.board.pieces) != game.check_tie_reference(player)
+            if not mask.any():
+                break
+
+            p, x, y = actions[rng.choice(np.flatnonzero(mask))]
+            game.make_move(x, y, p, player)
+            won = game.check_winner(player)
+            assert kernel.wins_through(game.board.owners, x, y, PLAYER_INDEX[player], size, game.n_pieces_in_a_row_to_win) == won
+            assert kernel.is_winner(game.board.owners, PLAYER_INDEX[player], size, game.n_pieces_in_a_row_to_win) == won
+            if won:
+                break
+            turn += 1
+
+def test_kernel_matches_reference():
+    check_kernel_against_reference(20)
+
+def test_python_kernel_matches_reference():
+    """The compiled functions call each other directly, so the pure Python
+    fallback is only exercised by a fresh process with the JIT disabled.
+    """
+    import os
+    import subprocess
+    import sys
+    code = (
+        "import kernel, test\n"
+        "assert kernel.BACKEND == 'python'\n"
+        "test.check_kernel_against_reference(3)\n"
+    )
+    env = {**os.environ, "PEPIPO_DISABLE_JIT": "1"}
+    result = subprocess.run([sys.executable, "-c", code], env=env, cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+def test_board_arrays_follow_board(game: Game):
+    game.make_move(3, 4, t_Piece.PE, "player_1")
+    game.make_move(3, 4, t_Piece.PI, "player_0")
+    cell = game.board.convert_xy_to_indx(3, 4)
+    assert list(game.board.pieces[cell]) == [t_Piece.PI.value, t_Piece.PE.value]
+    assert list(game.board.owners[cell]) == [0, 1]
+    game.board.empty_board()
+    assert not game.board.pieces.any() and (game.board.owners == kernel.NO_OWNER).all(), "empty_board did not clear the kernel arrays"
+
+def test_rollout_from_empty_board(game: Game):
+    stats = game.rollout("player_0", n_games=300, seed=7)
+    assert stats.n_games == 300
+    assert sum(stats.wins.values()) + stats.ties == 300
+    assert (stats.lengths > 0).all() and (stats.lengths <= 2 * 64).all()
+    assert not game.board.pieces.any(), "rollout modified the board"
+    again = game.rollout("player_0", n_games=300, seed=7, n_workers=2)
+    assert np.array_equal(stats.winners, again.winners) and np.array_equal(stats.lengths, again.lengths), "Same seed gave different rollouts"
+    with pytest.raises(AssertionError):
+        game.rollout("player_0", n_games=0)
+
+def test_rollout_forced_win(game: Game):
+    # every spot is blocked except (4, 0), which completes player_0's bottom row
+    for x in range(game.board.board_size):
+        for y in range(game.board.board_size):
+            if y == 0 and x < 4:
+                game.board[x, y] = Piece(t_Piece.PE, player_id="player_0")
+                game.board[x, y] = Piece(t_Piece.PI, player_id="player_0")
+            elif (x, y) != (4, 0):
+                game.board[x, y] = Piece(t_Piece.PO, player_id="player_1")
+    stats = game.rollout("player_0", n_games=50, weights=(1.0, 5.0, 0.1), seed=0)
+    assert stats.win_rate("player_0") == 1.0 and (stats.lengths == 1).all()
+
+def test_replay_rollout(game: Game):
+    game.make_move(3, 3, t_Piece.PE, "player_0")
+    stats = game.rollout("player_1", n_games=300, seed=11)
+    for game_id in (0, 257, 299):
+        winner, moves = game.replay_rollout("player_1", game_id, seed=11)
+        assert len(moves) == stats.lengths[game_id]
+        assert winner == (None if stats.winners[game_id] == -1 else f"player_{stats.winners[game_id]}")
+        # the moves must be legal when replayed on a copy of the position through the reference rules
+        replay = Game()
+        replay.make_move(3, 3, t_Piece.PE, "player_0")
+        for i, (piece, x, y) in enumerate(moves):
+            player = ["player_1", "player_0"][i % 2]
+            assert replay.validate_move(x, y, piece, player)
+            replay.make_move(x, y, piece, player)
+        assert winner is None or replay.check_winner(winner)
+
 
 @pytest.fixture
 def env():
@@ -145,6 +244,152 @@ def test_random_agent_game(env: PePiPoEnv):
         if t_steps > step_limit: assert False, f"Random game went above {step_limit} moves so something is wrong"
     env.close()
 
+def count_open_lines(game: Game, player_id: str) -> tuple[int, int]:
+    """Recounts (3+, 4+) open lines over the whole board with the reference Piece lists."""
+    n, size = game.n_pieces_in_a_row_to_win, game.board.board_size
+
+    def mine(cell):
+        return cell[0].player_id == player_id or cell[1].player_id == player_id
+
+    def is_open(cell):
+        return mine(cell) or cell[1]._typename == t_Piece.EMPTY or (cell[1]._typename == t_Piece.PE and cell[0]._typename == t_Piece.EMPTY)
+
+    counts = [0, 0]
+    for dx, dy in ((1, 0), (0, 1), (1, 1), (1, -1)):
+        for x in range(size):
+            for y in range(size):
+                cells = [(x + i * dx, y + i * dy) for i in range(n)]
+                if not all(0 <= cx < size and 0 <= cy < size for cx, cy in cells):
+                    continue
+                line = [game.board[cx, cy] for cx, cy in cells]
+                if all(is_open(c) for c in line):
+                    n_mine = sum(mine(c) for c in line)
+                    counts[0] += n_mine >= n - 2
+                    counts[1] += n_mine >= n - 1
+    return counts[0], counts[1]
+
+def test_shaped_rewards_match_full_recount():
+    shaping = RewardShaping(open3=0.01, open4=0.05, block4=0.05, po_spent=-0.02, aux_targets=True)
+    env = PePiPoEnv(render_mode=None, reward_shaping=shaping)
+    env.reset()
+    rng = np.random.default_rng(3)
+    while not env.terminations[env.agent_selection]:
+        agent = env.agent_selection
+        opponent = [a for a in env.agents if a != agent][0]
+        before = {a: count_open_lines(env.game, a) for a in env.agents}
+        action = int(rng.choice(np.flatnonzero(env.game.action_mask(agent))))
+        piece_type, _, _ = env.parse_piece_from_action(action)
+        env.step(action)
+        after = {a: count_open_lines(env.game, a) for a in env.agents}
+
+        aux = env.infos[agent]["aux"]
+        assert aux["open3"] == after[agent][0] - before[agent][0]
+        assert aux["open4"] == after[agent][1] - before[agent][1]
+        assert aux["block3"] == before[opponent][0] - after[opponent][0]
+        assert aux["block4"] == before[opponent][1] - after[opponent][1]
+        assert aux["po_spent"] == (piece_type == t_Piece.PO)
+        shaped = 0.01 * aux["open3"] + 0.05 * aux["open4"] + 0.05 * aux["block4"] - 0.02 * aux["po_spent"]
+        outcome = 1 if env.terminations[agent] and env.game.check_winner(agent) else 0
+        assert env.rewards[agent] == pytest.approx(outcome + shaped)
+
+def test_shaping_skips_disabled_terms():
+    env = PePiPoEnv(render_mode=None, reward_shaping=RewardShaping(po_spent=-0.5))
+    env.reset()
+    env.step(128) # PO at (0, 0)
+    assert env.infos["player_0"]["aux"] == {"po_spent": 1}
+    assert env.rewards["player_0"] == -0.5
+
+
+def test_planes_observation():
+    from encoder import PlanesConfig
+    env = PePiPoEnv(render_mode=None, obs_type="planes", reuse_obs_buffers=True)
+    env.reset()
+    env.step(64 + 8 * 2 + 3)  # player_0 PE at (2, 3)
+    env.step(2 * 64 + 8 * 5 + 5)  # player_1 PO at (5, 5)
+    env.step(8 * 2 + 3)  # player_0 PI at (2, 3)
+    env.step(64 + 8 * 1 + 1)  # player_1 PE at (1, 1)
+
+    obs = env.observe("player_0")["observation"]
+    assert obs.shape == PlanesConfig().shape(2, 8) and obs.dtype == np.float32
+    assert env.observation_space("player_0")["observation"].contains(obs)
+    # own PE/PI/PO planes, then the opponent's
+    assert obs[0, 2, 3] == 1 and obs[0].sum() == 1
+    assert obs[1, 2, 3] == 1 and obs[1].sum() == 1
+    assert obs[2].sum() == 0
+    assert obs[3, 1, 1] == 1 and obs[3].sum() == 1
+    assert obs[4].sum() == 0
+    assert obs[5, 5, 5] == 1 and obs[5].sum() == 1
+    # PO counts (own first), side to move, last move
+    assert (obs[6] == 1).all() and (obs[7] == 7 / 8).all()
+    assert (obs[8] == 1).all()
+    assert obs[9, 1, 1] == 1 and obs[9].sum() == 1
+
+    opponent = env.observe("player_1")["observation"]
+    assert opponent[3, 2, 3] == 1 and opponent[2, 5, 5] == 1 and (opponent[8] == 0).all()
+    assert env.observe("player_0")["observation"] is obs, "reuse_obs_buffers did not reuse the buffer"
+
+def test_planes_compliance_with_pettingzoo_api():
+    from pettingzoo.test import api_test
+    api_test(PePiPoEnv(render_mode=None, obs_type="planes"), num_cycles=200)
+
+
+def test_rgb_array_dirty_redraw_matches_full_redraw():
+    env = PePiPoEnv(render_mode="rgb_array")
+    env.reset()
+    empty = env.render()
+    assert empty.shape == (800, 800, 3) and empty.dtype == np.uint8
+    rng = np.random.default_rng(1)
+    for _ in range(12):
+        agent = env.agent_selection
+        env.step(int(rng.choice(np.flatnonzero(env.game.action_mask(agent)))))
+        frame = env.render()
+
+    # a fresh canvas drawn from scratch must look the same as the incrementally updated one
+    env._canvas = None
+    assert np.array_equal(env.render(), frame), "Dirty-cell redraw drifted from a full redraw"
+    env.reset()
+    assert np.array_equal(env.render(), empty), "reset did not clear the canvas"
+
+def test_ascii_board(game: Game):
+    game.make_move(0, 7, t_Piece.PE, "player_0")
+    rows = repr(game.board).split("\n")
+    assert rows[0] == "   |0 ||1 ||2 ||3 ||4 ||5 ||6 || 7|"
+    assert rows[2].startswith("7| |" + Piece(t_Piece.EMPTY).to_str() + Piece(t_Piece.PE, color=Colors.GREEN).to_str() + "|")
+    assert len(rows) == 2 + game.board.board_size + 2
+
+
+def test_reset_seed_is_reproducible(env: PePiPoEnv):
+    def play(seed):
+        env.reset(seed=seed)
+        actions = []
+        while not env.terminations[env.agent_selection]:
+            agent = env.agent_selection
+            actions.append(env.action_space(agent).sample(env.observe(agent)["action_mask"]))
+            env.step(actions[-1])
+        return actions
+
+    first = play(42)
+    assert play(42) == first, "Same seed gave a different game"
+    assert play(43) != first
+
+def test_tournament_games_replay_from_id():
+    from tournament import get_parser, run_tournament, replay_game, summarize_matchup
+    args = get_parser().parse_args(["--agents", "random", "rollout:2", "--n-games", "4", "--workers", "1", "--chunk-size", "3"])
+    report = run_tournament(args)
+    length = report["matchups"][0]["length"]
+    assert replay_game(args, length["longest_game_id"])[1] == length["max"]
+    assert replay_game(args, length["shortest_game_id"])[1] == length["min"]
+    assert run_tournament(args)["matchups"] == report["matchups"], "Same seed gave a different tournament"
+
+    # chunks finish out of order across workers, summaries must not depend on it
+    serial = get_parser().parse_args(["--agents", "random", "random", "--n-games", "40", "--workers", "1", "--chunk-size", "7"])
+    parallel = get_parser().parse_args(["--agents", "random", "random", "--n-games", "40", "--workers", "2", "--chunk-size", "1"])
+    assert run_tournament(parallel)["matchups"] == run_tournament(serial)["matchups"], "Results depend on the number of workers or the chunk size"
+    games_by_seat = {seat: [(2 * i + seat, 0, 10 + (i % 3)) for i in range(20)] for seat in (0, 1)}
+    shuffled = {seat: games[::-1] for seat, games in reversed(games_by_seat.items())}
+    assert summarize_matchup(shuffled, 0.95) == summarize_matchup(games_by_seat, 0.95)
+
+
 @pytest.mark.skip("Not written yet")
 def test_action_mask_generation(env: PePiPoEnv):
     return
@@ -152,3 +397,170 @@ def test_action_mask_generation(env: PePiPoEnv):
 @pytest.mark.skip("Not written yet")
 def test_observation_generation(env: PePiPoEnv):
     return
+
+def test_reset_restores_first_player(env: PePiPoEnv):
+    env.reset()
+    env.step(64) # PE at (0, 0)
+    assert env.agent_selection == "player_1"
+    env.reset()
+    assert env.agent_selection == "player_0", "reset did not hand the first move back to player_0"
+
+def test_tournament_round_robin():
+    from tournament import get_parser, run_tournament, wilson_interval
+    args = get_parser().parse_args(["--agents", "random", "random", "rollout:2", "--n-games", "5", "--workers", "1", "--chunk-size", "2"])
+    report = run_tournament(args)
+    assert len(report["matchups"]) == 3, "Every pair of agents should play exactly one matchup"
+    for m in report["matchups"]:
+        assert m["games"] == 5
+        assert m["wins"] + m["losses"] + m["ties"] == 5
+        assert m["by_seat"]["agent_id_1"]["games"] == 3 and m["by_seat"]["agent_id_2"]["games"] == 2, "Seats were not alternated"
+        low, high = m["win_rate_ci"]
+        assert 0 <= low <= m["win_rate"] <= high <= 1
+    low, high = wilson_interval(50, 100)
+    assert low < 0.5 < high and abs((0.5 - low) - (high - 0.5)) < 1e-9
+
+def test_monitor_logs_and_flags_regressions():
+    import gc
+    import time
+    from monitor import MonitorThresholds, RegressionError, ThroughputMonitor
+
+    class Logger:
+        def __init__(self):
+            self.rows = []
+        def write(self, step_type, step, data):
+            self.rows.append((step_type, step, data))
+
+    logger = Logger()
+    monitor = ThroughputMonitor(logger, MonitorThresholds(max_throughput_drop=0.5), fail_on_regression=True)
+    monitor.start()
+    try:
+        time.sleep(0.05)
+        warmup = monitor.sample(1, 0) # slow start-up sample, must neither be checked nor become the baseline
+        assert warmup is not None and monitor.baseline is None
+        time.sleep(0.01)
+        gc.collect()
+        baseline = monitor.sample(1000, 10)
+        assert monitor.baseline is baseline
+        assert baseline["monitor/steps_per_sec"] > 0 and baseline["monitor/rss_mb"] > 0
+        assert baseline["monitor/gc_collections_gen2"] >= 1, "GC callback did not record the collection"
+        assert [row[:2] for row in logger.rows] == [("monitor/env_step", 1), ("monitor/env_step", 1000)]
+        monitor.snapshot_allocations() # starts tracing
+        kept = [bytearray(1024) for _ in range(100)]
+        assert monitor.snapshot_allocations(), "tracemalloc snapshot should list the new allocations"
+        time.sleep(0.05)
+        with pytest.raises(RegressionError):
+            monitor.sample(1001, 10) # 1 step in 50ms is far below the baseline
+    finally:
+        monitor.stop()
+
+def test_tournament_dqn_agent_loads_train_checkpoint(tmp_path):
+    pytest.importorskip("tianshou")
+    import torch
+    from train import get_agents, get_parser
+    from tournament import build_agent, get_parser as get_tournament_parser, play_game, RandomAgent
+
+    # saved the way train.py's save_best_fn does, target network included
+    train_args = get_parser().parse_args(["--hidden-sizes", "16", "--device", "cpu"])
+    policy, _, agents = get_agents(train_args)
+    path = tmp_path / "policy.pth"
+    torch.save(policy.policies[agents[train_args.agent_id - 1]].state_dict(), path)
+
+    args = get_tournament_parser().parse_args(["--agents", "random", f"dqn:{path}", "--hidden-sizes", "16"])
+    dqn = build_agent(f"dqn:{path}", args)
+    env = PePiPoEnv(render_mode=None)
+    winner, n_moves = play_game(env, {"player_0": RandomAgent(np.random.default_rng(0)), "player_1": dqn}, seed=0)
+    assert n_moves > 0 and winner in (None, "player_0", "player_1")
+
+def test_actor_learner_smoke(tmp_path):
+    pytest.importorskip("tianshou")
+    from train import get_parser
+    from actor_learner import train_actor_learner
+    args = get_parser().parse_args([
+        "--actors", "1", "--epoch", "1", "--step-per-epoch", "40", "--step-per-collect", "10", "--batch-size", "8",
+        "--buffer-size", "200", "--test-num", "1", "--hidden-sizes", "16", "--device", "cpu", "--publish-every", "1",
+        "--logdir", str(tmp_path / "log"),
+    ])
+    args.model_save_path = str(tmp_path / "policy.pth")
+    result, _ = train_actor_learner(args)
+    assert result["env_step"] >= 40 and result["gradient_step"] > 0
+    assert (tmp_path / "policy.pth").exists()
+
+def test_actor_learner_bulk_add_matches_single_adds():
+    pytest.importorskip("tianshou")
+    from tianshou.data import Batch, ReplayBuffer, VectorReplayBuffer
+    from actor_learner import _add_chunk
+
+    def chunk(start, n):
+        # what an actor ships: an ordered slice of its own sub-buffer
+        source = ReplayBuffer(n)
+        for t in range(start, start + n):
+            source.add(Batch(obs=np.full(3, t), act=t % 5, rew=float(t), terminated=t % 4 == 3, truncated=False, obs_next=np.full(3, t + 1), info={}))
+        return source[source.sample_indices(0)]
+
+    bulk, single = VectorReplayBuffer(16, 2), VectorReplayBuffer(16, 2)
+    start = 0
+    for buffer_id, n in [(1, 3), (0, 5), (1, 6), (0, 1), (1, 12)]: # the last one wraps around
+        batch = chunk(start, n)
+        start += n
+        _add_chunk(bulk, buffer_id, batch)
+        for i in range(n):
+            single.add(batch[i:i + 1], buffer_ids=[buffer_id])
+        assert len(bulk) == len(single) and np.array_equal(bulk.last_index, single.last_index)
+        indices = single.sample_indices(0)
+        assert np.array_equal(np.sort(bulk.sample_indices(0)), np.sort(indices))
+        for key in ("obs", "act", "rew", "terminated", "obs_next"):
+            assert np.array_equal(getattr(bulk, key)[indices], getattr(single, key)[indices])
+        assert np.array_equal(bulk.prev(indices), single.prev(indices)) and np.array_equal(bulk.next(indices), single.next(indices))
+
+def test_actor_learner_raises_when_an_actor_dies():
+    import multiprocessing as mp
+    import sys
+    from actor_learner import _get_payload
+    ctx = mp.get_context("spawn")
+    actor = ctx.Process(target=sys.exit, args=(3,))
+    actor.start()
+    actor.join()
+    with pytest.raises(RuntimeError, match="exited with code 3"):
+        _get_payload(ctx.Queue(), [actor], timeout=0.1)
+
+def test_monitor_checks_worker_rss_and_dumps_allocations(tmp_path):
+    import os
+    import signal
+    from monitor import MonitorThresholds, RegressionError, ThroughputMonitor
+    monitor = ThroughputMonitor(thresholds=MonitorThresholds(max_rss_growth_mb=100), fail_on_regression=True)
+    monitor.start()
+    previous = signal.getsignal(signal.SIGUSR1)
+    try:
+        monitor.sample(10, 0, worker_rss={"actor0": 1000 * 2**20}, force=True) # warm-up
+        monitor.sample(20, 0, worker_rss={"actor0": 200 * 2**20}, force=True)
+        monitor.sample(30, 0, worker_rss={"actor0": 250 * 2**20, "actor1": 200 * 2**20}, force=True)
+        with pytest.raises(RegressionError, match="actor1 RSS grew"):
+            monitor.sample(40, 0, worker_rss={"actor0": 250 * 2**20, "actor1": 400 * 2**20}, force=True)
+
+        path = tmp_path / "allocations.txt"
+        monitor.dump_allocations_on_signal(str(path))
+        kept = [bytearray(1024) for _ in range(100)]
+        os.kill(os.getpid(), signal.SIGUSR1)
+        assert len(path.read_text().splitlines()) > 1, "the first dump should already list allocations"
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+        monitor.stop()
+
+def test_kernel_falls_back_when_numba_fails_to_import(tmp_path):
+    import os
+    import subprocess
+    import sys
+    # installed (find_spec sees it) but broken, like numba built against another numpy
+    (tmp_path / "numba").mkdir()
+    (tmp_path / "numba" / "__init__.py").write_text("raise ImportError('Numba needs NumPy 1.x')\n")
+    code = (
+        "import kernel\n"
+        "assert kernel.HAS_NUMBA\n"
+        "pieces, owners = kernel.new_board(8)\n"
+        "assert kernel.has_valid_move(pieces)\n"
+        "assert kernel.BACKEND == 'python', kernel.BACKEND\n"
+    )
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join([str(tmp_path), os.path.dirname(os.path.abspath(__file__))])}
+    env.pop("PEPIPO_DISABLE_JIT", None)
+    result = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
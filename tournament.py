@@ -0,0 +1,346 @@
+"""Headless round-robin evaluation of PePiPo agents.
+
+Every pair of agents plays `--n-games` games, half with each agent in the
+first seat (`--agent-id` 1, player_0) and half in the second seat
+(`--agent-id` 2, player_1). Games are spread across a process pool and the
+results are written to a JSON report.
+
+    ```
+    python tournament.py --agents random dqn:models/exp_123/policy.pth --n-games 2000
+    ```
+"""
+from pepipoenv import PePiPoEnv
+from seeding import derive_seed, make_rng
+import kernel
+
+import argparse
+import itertools
+import json
+import math
+import multiprocessing as mp
+import os
+import time
+from statistics import NormalDist
+from typing import Optional
+
+import numpy as np
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--agents', type=str, nargs='+', default=['random', 'random'], help="Agent specs: 'random', 'rollout[:<rollouts per move>]' or 'dqn:<path to policy.pth>'")
+    parser.add_argument('--n-games', type=int, default=1000, help="Games per matchup, split evenly between both seats. Default 1000")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Number of worker processes. Default os.cpu_count()")
+    parser.add_argument('--chunk-size', type=int, default=50, help="Games handed to a worker at a time. Default 50")
+    parser.add_argument('--seed', type=int, default=1626, help="Root seed. Game i is played with its own stream derived from (seed, i)")
+    parser.add_argument('--replay-game', type=int, default=None, help="Replay (and print) a single game of the tournament by id instead of running it")
+    parser.add_argument('--eps-test', type=float, default=0.0, help="Epsilon used by DQN agents during evaluation. Default 0")
+    parser.add_argument('--hidden-sizes', type=int, nargs='*', default=[128, 128, 128, 128], help="Hidden sizes of the DQN checkpoints")
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--obs-type', type=str, default='category', choices=['category', 'planes'], help="Observation type the DQN checkpoints were trained on. Default category")
+    parser.add_argument('--confidence', type=float, default=0.95, help="Confidence level of the win rate intervals. Default 0.95")
+    parser.add_argument('--report', type=str, default='tournament.json', help="Path of the JSON report. Default ./tournament.json")
+    return parser
+
+
+# ======== agents =========
+class RandomAgent:
+    """Picks uniformly among the legal actions."""
+
+    def __init__(self, rng: Optional[np.random.Generator] = None) -> None:
+        self.rng = rng if rng is not None else np.random.default_rng()
+
+    def act(self, env: PePiPoEnv, agent: str) -> int:
+        legal = np.flatnonzero(env.game.action_mask(agent))
+        return int(self.rng.choice(legal))
+
+
+class RolloutAgent:
+    """Flat Monte Carlo search: plays `n_rollouts` random games after every legal
+    move and picks the move with the best score (wins + half the ties).
+    """
+
+    def __init__(self, n_rollouts: int = 16, rng: Optional[np.random.Generator] = None) -> None:
+        self.n_rollouts = n_rollouts
+        self._no_actions = np.empty((0, 0), dtype=np.int16)
+        self.rng = rng if rng is not None else np.random.default_rng()
+
+    def act(self, env: PePiPoEnv, agent: str) -> int:
+        game = env.game
+        board_size = game.board.board_size
+        me = env.possible_agents.index(agent)
+        po_left = np.array([game.po_per_player[p] for p in env.possible_agents], dtype=np.int16)
+        weights = np.ones(len(kernel.ACTION_PIECES), dtype=np.float64)
+        winners = np.empty(self.n_rollouts, dtype=np.int8)
+        lengths = np.empty(self.n_rollouts, dtype=np.int16)
+
+        legal = np.flatnonzero(game.action_mask(agent))
+        self.rng.shuffle(legal) # break ties randomly
+        best_action, best_score = int(legal[0]), -1.0
+        for action in legal:
+            piece_type, x, y = env.parse_piece_from_action(action)
+            pieces, owners, po = game.board.pieces.copy(), game.board.owners.copy(), po_left.copy()
+            kernel.place(pieces, owners, x, y, piece_type.value, me, board_size)
+            if kernel.wins_through(owners, x, y, me, board_size, game.n_pieces_in_a_row_to_win):
+                return int(action)
+            if piece_type.value == kernel.PO:
+                po[me] -= 1
+            uniforms = self.rng.random((self.n_rollouts, 2 * board_size * board_size))
+            kernel.playouts(pieces, owners, po, (me + 1) % len(po), weights, uniforms, board_size, game.n_pieces_in_a_row_to_win, winners, lengths, self._no_actions)
+            score = ((winners == me).sum() + 0.5 * (winners == kernel.NO_OWNER).sum()) / self.n_rollouts
+            if score > best_score:
+                best_action, best_score = int(action), score
+        return best_action
+
+
+class DQNAgent:
+    """Greedy (or epsilon-greedy) player backed by a policy saved by train.py."""
+
+    def __init__(self, path: str, hidden_sizes: list[int], device: str = "cpu", eps: float = 0.0, obs_type: str = "category", rng: Optional[np.random.Generator] = None) -> None:
+        import torch
+        from tianshou.utils.net.common import Net
+
+        env = PePiPoEnv(obs_type=obs_type)
+        agent = env.possible_agents[0]
+        observation_space = env.observation_space(agent)["observation"]
+        action_space = env.action_space(agent)
+        net = Net(observation_space.shape, action_space.n, hidden_sizes=hidden_sizes, device=device).to(device)
+        # train.py saves the whole DQNPolicy state, whose target network (model_old.*)
+        # depends on its target_update_freq; only the online network is needed to play
+        state = torch.load(path, map_location=device)
+        net.load_state_dict({k[len("model."):]: v for k, v in state.items() if k.startswith("model.")})
+        net.eval()
+
+        self.torch = torch
+        self.net = net
+        self.device = device
+        self.eps = eps
+        self.rng = rng if rng is not None else np.random.default_rng()
+
+    def act(self, env: PePiPoEnv, agent: str) -> int:
+        observation = env.observe(agent)
+        mask = observation["action_mask"].astype(bool)
+        if self.eps > 0 and self.rng.random() < self.eps:
+            return int(self.rng.choice(np.flatnonzero(mask)))
+        with self.torch.no_grad():
+            logits, _ = self.net(observation["observation"][None])
+        q = logits[0].cpu().numpy()
+        q[~mask] = -np.inf
+        return int(q.argmax())
+
+
+def build_agent(spec: str, args: argparse.Namespace, rng: Optional[np.random.Generator] = None):
+    """Builds an agent from a spec string such as 'random', 'rollout:32' or 'dqn:path/to/policy.pth'."""
+    kind, _, path = spec.partition(":")
+    if kind == "random":
+        return RandomAgent(rng=rng)
+    if kind == "rollout":
+        return RolloutAgent(n_rollouts=int(path) if path else 16, rng=rng)
+    if kind == "dqn":
+        assert path, f"dqn agents need a checkpoint path, e.g. 'dqn:models/exp_1/policy.pth', got '{spec}'"
+        return DQNAgent(path, args.hidden_sizes, device=args.device, eps=args.eps_test, obs_type=args.obs_type, rng=rng)
+    raise ValueError(f"Unknown agent spec '{spec}'")
+
+
+# ======== games =========
+def play_game(env: PePiPoEnv, seats: dict, seed: Optional[int] = None, verbose: bool = False) -> tuple[Optional[str], int]:
+    """Plays one game to completion. Returns the winning player id (None on a tie) and the number of moves."""
+    env.reset(seed=seed)
+    n_moves = 0
+    while not env.terminations[env.agent_selection]:
+        agent = env.agent_selection
+        action = seats[agent].act(env, agent)
+        env.step(action)
+        n_moves += 1
+        if verbose:
+            piece_type, x, y = env.parse_piece_from_action(action)
+            print(f"move {n_moves}: {agent} plays {piece_type.name} at ({x}, {y})")
+            env.game.print_board()
+    winners = [a for a, r in env.rewards.items() if r > 0]
+    return (winners[0] if winners else None), n_moves
+
+
+_worker_args: Optional[argparse.Namespace] = None
+_worker_agents: dict = {}
+
+
+def _init_worker(args: argparse.Namespace) -> None:
+    global _worker_args
+    _worker_args = args
+    _worker_agents.clear()
+
+
+def _play_chunk(task: tuple[int, int, int, int, int], verbose: bool = False) -> tuple[int, int, int, list[tuple[int, int, int]]]:
+    """Plays games first_game .. first_game + n_games - 1: agent `a` in seat `seat_a` against agent `b`.
+    Returns the task keys and one (game id, outcome for a, game length) triple per game.
+    """
+    a, b, seat_a, first_game, n_games = task
+    # checkpoints are loaded once per worker
+    for i in (a, b):
+        if i not in _worker_agents:
+            _worker_agents[i] = build_agent(_worker_args.agents[i], _worker_args, None)
+
+    env = PePiPoEnv(render_mode=None, obs_type=_worker_args.obs_type)
+    player_a = env.possible_agents[seat_a]
+    player_b = env.possible_agents[1 - seat_a]
+    seats = {player_a: _worker_agents[a], player_b: _worker_agents[b]}
+
+    games = []
+    for game_id in range(first_game, first_game + n_games):
+        # every game gets its own stream, so it can be replayed from its id alone
+        rng = make_rng(_worker_args.seed, game_id)
+        _worker_agents[a].rng = _worker_agents[b].rng = rng
+        winner, n_moves = play_game(env, seats, seed=derive_seed(_worker_args.seed, game_id), verbose=verbose)
+        outcome = 0 if winner is None else (1 if winner == player_a else -1)
+        games.append((game_id, outcome, n_moves))
+    return a, b, seat_a, games
+
+
+# ======== statistics =========
+def wilson_interval(successes: float, n: int, confidence: float = 0.95) -> tuple[float, float]:
+    """Wilson score interval for a binomial proportion."""
+    if n == 0:
+        return 0.0, 1.0
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    p = successes / n
+    denom = 1 + z**2 / n
+    centre = (p + z**2 / (2 * n)) / denom
+    half = z * math.sqrt(p * (1 - p) / n + z**2 / (4 * n**2)) / denom
+    low = 0.0 if successes == 0 else max(0.0, centre - half)
+    high = 1.0 if successes == n else min(1.0, centre + half)
+    return low, high
+
+
+def summarize_matchup(games_by_seat: dict[int, list[tuple[int, int, int]]], confidence: float) -> dict:
+    """Win/loss/tie counts, win rate interval and game length stats for one matchup (from agent a's side)."""
+    # chunks come back in any order, sort so results only depend on the seed
+    all_games = sorted(g for games in games_by_seat.values() for g in games)
+    game_ids = np.array([i for i, _, _ in all_games], dtype=np.int64)
+    outcomes = np.array([o for _, o, _ in all_games], dtype=np.int8)
+    lengths = np.array([n for _, _, n in all_games], dtype=np.int64)
+    n = len(all_games)
+    wins, losses = int((outcomes == 1).sum()), int((outcomes == -1).sum())
+    ties = n - wins - losses
+    low, high = wilson_interval(wins, n, confidence)
+    summary = {
+        "games": n,
+        "wins": wins,
+        "losses": losses,
+        "ties": ties,
+        "win_rate": wins / n if n else 0.0,
+        "win_rate_ci": [low, high],
+        "score": (wins + 0.5 * ties) / n if n else 0.0,
+        "length": {
+            "mean": float(lengths.mean()) if n else 0.0,
+            "std": float(lengths.std()) if n else 0.0,
+            "min": int(lengths.min()) if n else 0,
+            "max": int(lengths.max()) if n else 0,
+            "shortest_game_id": int(game_ids[lengths.argmin()]) if n else None,
+            "longest_game_id": int(game_ids[lengths.argmax()]) if n else None,
+        },
+        "by_seat": {},
+    }
+    for seat, games in sorted(games_by_seat.items()):
+        seat_outcomes = [o for _, o, _ in games]
+        summary["by_seat"][f"agent_id_{seat + 1}"] = {
+            "games": len(games),
+            "wins": seat_outcomes.count(1),
+            "losses": seat_outcomes.count(-1),
+            "ties": seat_outcomes.count(0),
+        }
+    return summary
+
+
+# ======== tournament =========
+def make_tasks(n_agents: int, n_games: int, chunk_size: int) -> list[tuple[int, int, int, int, int]]:
+    """Splits every matchup into chunks of at most `chunk_size` games, alternating seats.
+    Each task is (a, b, seat_a, first_game_id, n_games); game ids number every game of the tournament.
+    """
+    tasks = []
+    game_id = 0
+    for a, b in itertools.combinations(range(n_agents), 2):
+        for seat_a in (0, 1):
+            # first seat gets the odd game out
+            remaining = (n_games + 1 - seat_a) // 2
+            while remaining > 0:
+                n = min(chunk_size, remaining)
+                tasks.append((a, b, seat_a, game_id, n))
+                game_id += n
+                remaining -= n
+    return tasks
+
+
+def replay_game(args: argparse.Namespace, game_id: int) -> tuple[int, int]:
+    """Plays game `game_id` of the tournament described by `args` again, printing every move.
+    Returns the outcome for the first agent of the matchup and the game length.
+    """
+    for a, b, seat_a, first_game, n_games in make_tasks(len(args.agents), args.n_games, args.chunk_size):
+        if first_game <= game_id < first_game + n_games:
+            _init_worker(args)
+            print(f"Game {game_id}: {a}:{args.agents[a]} as player_{seat_a} vs {b}:{args.agents[b]} as player_{1 - seat_a}")
+            _, outcome, n_moves = _play_chunk((a, b, seat_a, game_id, 1), verbose=True)[3][0]
+            return outcome, n_moves
+    raise ValueError(f"Game {game_id} is not part of this tournament")
+
+
+def run_tournament(args: argparse.Namespace) -> dict:
+    assert len(args.agents) > 1, "A tournament needs at least two agents"
+    tasks = make_tasks(len(args.agents), args.n_games, args.chunk_size)
+    results: dict[tuple[int, int], dict[int, list]] = {}
+
+    start = time.perf_counter()
+    if args.workers > 1:
+        with mp.Pool(args.workers, initializer=_init_worker, initargs=(args,)) as pool:
+            chunks = list(pool.imap_unordered(_play_chunk, tasks))
+    else:
+        _init_worker(args)
+        chunks = [_play_chunk(t) for t in tasks]
+    elapsed = time.perf_counter() - start
+
+    for a, b, seat_a, games in chunks:
+        results.setdefault((a, b), {}).setdefault(seat_a, []).extend(games)
+
+    matchups = []
+    for (a, b), games_by_seat in sorted(results.items()):
+        matchups.append({
+            "agent_a": f"{a}:{args.agents[a]}",
+            "agent_b": f"{b}:{args.agents[b]}",
+            **summarize_matchup(games_by_seat, args.confidence),
+        })
+    n_games = sum(m["games"] for m in matchups)
+    return {
+        "agents": args.agents,
+        "seed": args.seed,
+        "confidence": args.confidence,
+        "total_games": n_games,
+        "seconds": elapsed,
+        "games_per_sec": n_games / elapsed if elapsed > 0 else 0.0,
+        "matchups": matchups,
+    }
+
+
+def print_report(report: dict) -> None:
+    print(f"{report['total_games']} games in {report['seconds']:.1f}s ({report['games_per_sec']:.0f} games/s)")
+    for m in report["matchups"]:
+        low, high = m["win_rate_ci"]
+        print(f"{m['agent_a']} vs {m['agent_b']}: "
+              f"W/L/T {m['wins']}/{m['losses']}/{m['ties']}, "
+              f"win rate {m['win_rate']:.3f} [{low:.3f}, {high:.3f}], "
+              f"length {m['length']['mean']:.1f} +- {m['length']['std']:.1f}")
+
+
+def main() -> None:
+    args = get_parser().parse_args()
+    if args.replay_game is not None:
+        outcome, n_moves = replay_game(args, args.replay_game)
+        print(f"Outcome for the first agent: {outcome}, length: {n_moves}")
+        return
+    report = run_tournament(args)
+    print_report(report)
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
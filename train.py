@@ -1,29 +1,25 @@
-from pepipoenv import PePiPoEnv
+from __future__ import annotations
+
+from monitor import MonitorThresholds, ThroughputMonitor
+from pepipoenv import PePiPoEnv, RewardShaping
+from seeding import TEST_ENVS, TRAIN_ENVS, derive_seed
 
 import argparse
 from random import randint
 import os
 from copy import deepcopy
-from typing import Optional, Tuple
+from typing import TYPE_CHECKING, Optional, Tuple
 from pprint import pprint
 
 import gymnasium as gym
 import numpy as np
-import torch
-from torch.utils.tensorboard import SummaryWriter
-
-from tianshou.data import Collector, VectorReplayBuffer
-from tianshou.env import DummyVectorEnv
-from tianshou.env.pettingzoo_env import PettingZooEnv
-from tianshou.policy import (
-    BasePolicy,
-    DQNPolicy,
-    MultiAgentPolicyManager,
-    RandomPolicy,
-)
-from tianshou.trainer import OffpolicyTrainer
-from tianshou.utils import TensorboardLogger
-from tianshou.utils.net.common import Net
+
+# torch and tianshou take seconds to import, so they are only imported by the
+# functions that need them; importing this module stays cheap
+if TYPE_CHECKING:
+    import torch
+    from tianshou.env.pettingzoo_env import PettingZooEnv
+    from tianshou.policy import BasePolicy
 
 def generate_random_experiment_name() -> str:
     return f"exp_{randint(0, 9999)}"
@@ -54,22 +50,49 @@ def get_parser() -> argparse.ArgumentParser:
     parser.add_argument('--agent-id', type=int, default=2, help='the learned agent plays as the agent_id-th player. Choices are 1 (player_0) and 2 (player_1).')
     parser.add_argument('--resume-path', type=str, default='', help='the path of agent pth file for resuming from a pre-trained agent')
     parser.add_argument('--opponent-path', type=str, default='', help='the path of opponent agent pth file for resuming from a pre-trained agent')
-    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--device', type=str, default=None, help="Default cuda if available, else cpu")
     parser.add_argument("--n-watch-eps", type=int, default=10, help="Number of episodes to watch. Default 10")
+    parser.add_argument('--obs-type', type=str, default='category', choices=['category', 'planes'], help="'category' (8x8x1 cell categories) or 'planes' (channel-first planes for CNNs). Default category")
+    parser.add_argument('--shape-open3', type=float, default=0.0, help="Reward weight for each new open line with 3+ own pieces. Default 0 (off)")
+    parser.add_argument('--shape-open4', type=float, default=0.0, help="Reward weight for each new open line with 4+ own pieces. Default 0 (off)")
+    parser.add_argument('--shape-block3', type=float, default=0.0, help="Reward weight for each opponent open line with 3+ pieces blocked. Default 0 (off)")
+    parser.add_argument('--shape-block4', type=float, default=0.0, help="Reward weight for each opponent open line with 4+ pieces blocked. Default 0 (off)")
+    parser.add_argument('--shape-po-spent', type=float, default=0.0, help="Reward weight for placing a PO, negative to save POs. Default 0 (off)")
+    parser.add_argument('--actors', type=int, default=0, help="Number of actor processes collecting transitions for an asynchronous learner. Default 0 (collect and train in turns on one thread)")
+    parser.add_argument('--envs-per-actor', type=int, default=1, help="Envs stepped by each actor. Default 1")
+    parser.add_argument('--publish-every', type=int, default=10, help="Gradient steps between weight updates sent to the actors. Default 10")
+    parser.add_argument('--max-staleness', type=int, default=4, help="Drop transitions collected with weights more than this many versions old. Default 4")
+    parser.add_argument('--queue-size', type=int, default=0, help="Transition batches the actors can queue before blocking. Default 2 * actors")
+    parser.add_argument('--monitor-interval', type=float, default=30.0, help="Seconds between throughput/memory samples logged under monitor/. 0 disables the monitor. Default 30")
+    parser.add_argument('--benchmark', default=False, action='store_true', help='fail the run when a monitor sample breaks --max-throughput-drop, --max-rss-growth-mb or --min-steps-per-sec (otherwise only warn)')
+    parser.add_argument('--max-throughput-drop', type=float, default=0.0, help="Allowed drop of env steps/sec as a fraction of the baseline (the sample after the first, warm-up one), e.g. 0.3. Default 0 (off)")
+    parser.add_argument('--max-rss-growth-mb', type=float, default=0.0, help="Allowed RSS growth over the baseline (the sample after the first, warm-up one) in MB. Default 0 (off)")
+    parser.add_argument('--min-steps-per-sec', type=float, default=0.0, help="Lowest allowed env steps/sec. Default 0 (off)")
+    parser.add_argument('--alloc-snapshots', default=False, action='store_true', help='append a tracemalloc snapshot to <logdir>/<exp_id>/allocations.txt on SIGUSR1')
+    parser.add_argument('--aux-targets', default=False, action='store_true', help='report every shaping term in infos["aux"], even the ones with weight 0')
     return parser
 
 def get_args() -> argparse.Namespace:
     parser = get_parser()
-    return parser.parse_known_args()[0]
+    args = parser.parse_known_args()[0]
+    if args.device is None:
+        import torch
+        args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return args
 
 
 def get_agents(
-    args: argparse.Namespace = get_args(),
+    args: Optional[argparse.Namespace] = None,
     agent_learn: Optional[BasePolicy] = None,
     agent_opponent: Optional[BasePolicy] = None,
     optim: Optional[torch.optim.Optimizer] = None,
 ) -> Tuple[BasePolicy, torch.optim.Optimizer, list]:
-    env = get_env()
+    import torch
+    from tianshou.policy import DQNPolicy, MultiAgentPolicyManager, RandomPolicy
+    from tianshou.utils.net.common import Net
+
+    args = args if args is not None else get_args()
+    env = get_env(obs_type=args.obs_type)
     observation_space = env.observation_space['observation'] if isinstance(
         env.observation_space, gym.spaces.Dict
     ) else env.observation_space
@@ -110,28 +133,64 @@ def get_agents(
     policy = MultiAgentPolicyManager(agents, env)
     return policy, optim, env.agents
 
-def get_env(render_mode=None):
-    return PettingZooEnv(PePiPoEnv(render_mode=render_mode))
+def get_reward_shaping(args: argparse.Namespace) -> Optional[RewardShaping]:
+    shaping = RewardShaping(
+        open3=args.shape_open3,
+        open4=args.shape_open4,
+        block3=args.shape_block3,
+        block4=args.shape_block4,
+        po_spent=args.shape_po_spent,
+        aux_targets=args.aux_targets,
+    )
+    return shaping if shaping.active_terms() else None
+
+def get_monitor(args: argparse.Namespace, logger=None) -> Optional[ThroughputMonitor]:
+    if args.monitor_interval <= 0:
+        return None
+    thresholds = MonitorThresholds(
+        max_throughput_drop=args.max_throughput_drop,
+        max_rss_growth_mb=args.max_rss_growth_mb,
+        min_steps_per_sec=args.min_steps_per_sec,
+    )
+    monitor = ThroughputMonitor(logger, thresholds, fail_on_regression=args.benchmark, interval=args.monitor_interval)
+    if args.alloc_snapshots:
+        monitor.dump_allocations_on_signal(os.path.join(args.logdir, args.exp_id, "allocations.txt"))
+    return monitor
+
+
+def get_env(render_mode=None, reward_shaping: Optional[RewardShaping] = None, obs_type: str = "category") -> PettingZooEnv:
+    from tianshou.env.pettingzoo_env import PettingZooEnv
+    return PettingZooEnv(PePiPoEnv(render_mode=render_mode, reward_shaping=reward_shaping, obs_type=obs_type))
 
 
 def train_agent(
-    args: argparse.Namespace = get_args(),
+    args: Optional[argparse.Namespace] = None,
     agent_learn: Optional[BasePolicy] = None,
     agent_opponent: Optional[BasePolicy] = None,
     optim: Optional[torch.optim.Optimizer] = None,
 ) -> Tuple[dict, BasePolicy]:
-    
+    import torch
+    from torch.utils.tensorboard import SummaryWriter
+    from tianshou.data import Collector, VectorReplayBuffer
+    from tianshou.env import DummyVectorEnv
+    from tianshou.trainer import OffpolicyTrainer
+    from tianshou.utils import TensorboardLogger
+
+    args = args if args is not None else get_args()
+
     # set experiment ID
     args.exp_id = generate_random_experiment_name()
 
     # ======== environment setup =========
-    train_envs = DummyVectorEnv([get_env for _ in range(args.training_num)])
-    test_envs = DummyVectorEnv([get_env for _ in range(args.test_num)])
+    reward_shaping = get_reward_shaping(args)
+    train_envs = DummyVectorEnv([lambda: get_env(reward_shaping=reward_shaping, obs_type=args.obs_type) for _ in range(args.training_num)])
+    test_envs = DummyVectorEnv([lambda: get_env(obs_type=args.obs_type) for _ in range(args.test_num)])
     # seed
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
-    train_envs.seed(args.seed)
-    test_envs.seed(args.seed)
+    # every env gets its own stream derived from the root seed
+    train_envs.seed([derive_seed(args.seed, TRAIN_ENVS, i) for i in range(args.training_num)])
+    test_envs.seed([derive_seed(args.seed, TEST_ENVS, i) for i in range(args.test_num)])
 
     # ======== agent setup =========
     policy, optim, agents = get_agents(args, agent_learn=agent_learn, agent_opponent=agent_opponent, optim=optim)
@@ -153,6 +212,7 @@ def train_agent(
     writer = SummaryWriter(log_path)
     writer.add_text("args", str(args))
     logger = TensorboardLogger(writer)
+    monitor = get_monitor(args, logger)
 
     # ======== callback functions used during training =========
     def save_best_fn(policy):
@@ -168,6 +228,8 @@ def train_agent(
 
     def train_fn(epoch, env_step):
         policy.policies[agents[args.agent_id - 1]].set_eps(args.eps_train)
+        if monitor is not None:
+            monitor.sample(train_collector.collect_step, train_collector.collect_episode)
 
     def test_fn(epoch, env_step):
         policy.policies[agents[args.agent_id - 1]].set_eps(args.eps_test)
@@ -176,34 +238,44 @@ def train_agent(
         return rews[:, args.agent_id - 1]
 
     # trainer
-    result = OffpolicyTrainer(
-        policy,
-        train_collector,
-        test_collector,
-        args.epoch,
-        args.step_per_epoch,
-        args.step_per_collect,
-        args.test_num,
-        args.batch_size,
-        train_fn=train_fn,
-        test_fn=test_fn,
-        stop_fn=stop_fn,
-        save_best_fn=save_best_fn,
-        update_per_step=args.update_per_step,
-        logger=logger,
-        test_in_train=False,
-        reward_metric=reward_metric,
-        verbose=True
-    ).run()
+    if monitor is not None:
+        monitor.start(train_collector.collect_step, train_collector.collect_episode)
+    try:
+        result = OffpolicyTrainer(
+            policy,
+            train_collector,
+            test_collector,
+            args.epoch,
+            args.step_per_epoch,
+            args.step_per_collect,
+            args.test_num,
+            args.batch_size,
+            train_fn=train_fn,
+            test_fn=test_fn,
+            stop_fn=stop_fn,
+            save_best_fn=save_best_fn,
+            update_per_step=args.update_per_step,
+            logger=logger,
+            test_in_train=False,
+            reward_metric=reward_metric,
+            verbose=True
+        ).run()
+    finally:
+        if monitor is not None:
+            monitor.stop()
 
     return result, policy.policies[agents[args.agent_id - 1]]
 
 # ======== a test function that tests a pre-trained agent ======
-def watch(args: argparse.Namespace = get_args(),
+def watch(args: Optional[argparse.Namespace] = None,
     agent_learn: Optional[BasePolicy] = None,
     agent_opponent: Optional[BasePolicy] = None,
 ) -> None:
-    env = get_env(render_mode="human")
+    from tianshou.data import Collector
+    from tianshou.env import DummyVectorEnv
+
+    args = args if args is not None else get_args()
+    env = get_env(render_mode="human", obs_type=args.obs_type)
     env = DummyVectorEnv([lambda: env])
 
     policy, optim, agents = get_agents(args, agent_learn=agent_learn, agent_opponent=agent_opponent)
@@ -219,12 +291,20 @@ def watch(args: argparse.Namespace = get_args(),
     print(f"Total wins: {sum([1 if arr[1] > 0 else 0 for arr in result['rews']])} / {result['n/ep']}")
 
 # train the agent and watch its performance in a match!
-args = get_args()
+def main() -> None:
+    args = get_args()
+    if args.watch:
+        watch(args)
+    elif args.actors > 0:
+        from actor_learner import train_actor_learner
+        result, agent = train_actor_learner(args)
+        pprint(result)
+    else:
+        result, agent = train_agent(args)
+
 
-if args.watch: 
-    watch(args)
-else:
-    result, agent = train_agent(args)
+if __name__ == "__main__":
+    main()
 
 
 